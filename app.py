@@ -1,7 +1,25 @@
-from datetime import datetime
-from functools import wraps
-
-from flask import Flask, abort, redirect, render_template, request, url_for
+import hashlib
+import json
+import os
+import queue
+import re
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import cache, wraps
+
+from flask import (
+    Flask,
+    Response,
+    abort,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    stream_with_context,
+    url_for,
+)
 from flask_login import (
     LoginManager,
     UserMixin,
@@ -11,20 +29,72 @@ from flask_login import (
     logout_user,
 )
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects import postgresql, sqlite
 from werkzeug.security import check_password_hash, generate_password_hash
 from pubsub import pub
 
-from config import config
-from prompts.prompts import AgentOODA, ManagerOODA, ClientOODA
+import instrumentation
+from config import config, config_name
+from prompts.actions import ActionRegistry
+from prompts.cache import MemoryCache
+from prompts.prompts import AgentOODA, ManagerOODA, ClientOODA, current_attempt
+from prompts.observation import (
+    SUMMARY_HEADING,
+    count_tokens,
+    render_observation,
+    split_tokens,
+    split_window,
+    summarize,
+    truncate_to_tokens,
+)
 import tools
 
 app = Flask(__name__)
-app.config.from_object(config["development"])
-app.debug = True
+app.config.from_object(config[config_name])
+config[config_name].init_app(app)
 
 # Initialize the database
 db = SQLAlchemy(app)
 
+
+def configure_sqlite(dbapi_connection, connection_record):
+    """WAL lets web reads proceed while an AI worker writes, and the busy
+    timeout makes concurrent writers wait for the lock instead of failing
+    with "database is locked"
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout = {app.config['SQLITE_BUSY_TIMEOUT_MS']}")
+    cursor.execute("PRAGMA journal_mode = WAL")
+    # safe with WAL, only the last commits can be lost on power failure
+    cursor.execute("PRAGMA synchronous = NORMAL")
+    cursor.close()
+
+
+with app.app_context():
+    if db.engine.dialect.name == "sqlite":
+        db.event.listen(db.engine, "connect", configure_sqlite)
+
+
+@contextmanager
+def session_scope():
+    """A session of its own for database work outside of a request or job,
+    e.g. in pubsub listeners, which run in the publisher's thread.
+
+    It is committed on success, rolled back on error and always closed, so
+    its connection goes straight back to the pool and the publisher's
+    session is left alone.
+    """
+    session = db.session.session_factory()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
 # Initialize the login manager
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -35,49 +105,97 @@ login_manager.login_view = (
 
 # create and register a pubsub listener
 def task_listener(task_id, user_ids):
-    print("Function listener1 received:")
-    print(f"task_id: {task_id}")
-    # Get the task from the database
-    task = Task.query.get(task_id)
-
-    # Get the users from the database
-    users = User.query.filter(User.id.in_(user_ids)).all()
-    print(f"users: {users}")
-    for user in users:
-        if user.username == "managerai":
-            ai = ManagerAI()
-            ai.handle_task(task=task, as_user=user)
-        if user.username == "agentai":
-            ai = AgentAI()
-            ai.handle_task(task=task, as_user=user)
+    """Queue an AI job for the task instead of running the AI inline, so the
+    publisher (usually an HTTP request) returns immediately"""
+    enqueue_job(task_id=task_id, user_ids=user_ids)
 
 
 pub.subscribe(task_listener, "tasks")
 
 
+def ooda_options(task):
+    """Keyword arguments for the OODA classes, streaming when enabled"""
+    if not app.config["AI_STREAM"]:
+        return {}
+    task_id = task.id
+
+    def on_token(phase, piece):
+        pub.sendMessage("ooda", task_id=task_id, phase=phase, piece=piece)
+
+    return {"stream": True, "on_token": on_token}
+
+
 class Task(db.Model):
+    __table_args__ = (
+        # task lists of a user, filtered by status and paginated by id
+        db.Index("ix_task_client_id_is_open_id", "client_id", "is_open", "id"),
+        db.Index("ix_task_worker_id_is_open_id", "worker_id", "is_open", "id"),
+        db.Index("ix_task_parent_task_id_id", "parent_task_id", "id"),
+        # tasks of a batch in a given state, started in id order
+        db.Index(
+            "ix_task_batch_id_batch_status_id", "batch_id", "batch_status", "id"
+        ),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(128), nullable=False)
     is_open = db.Column(db.Boolean, nullable=False, default=True)
     is_complete = db.Column(db.Boolean, nullable=False, default=False)
     client_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
     worker_id = db.Column(db.Integer, db.ForeignKey("user.id"))
-    discussion = db.relationship("TaskDiscussion", backref="task", lazy=True)
+    discussion = db.relationship(
+        "TaskDiscussion", backref="task", lazy=True, order_by="TaskDiscussion.id"
+    )
     parent_task_id = db.Column(db.Integer, db.ForeignKey("task.id"))
     subtasks = db.relationship(
         "Task", backref=db.backref("parent_task", remote_side=[id]), lazy=True
     )
+    # Rollups kept up to date incrementally by the methods below: the direct
+    # subtasks that are open and complete, the messages on this task, and the
+    # last message anywhere in its subtree
+    open_subtask_count = db.Column(db.Integer, nullable=False, default=0)
+    complete_subtask_count = db.Column(db.Integer, nullable=False, default=0)
+    # complete_subtask_count when their results were last joined into this
+    # task, see join_subtasks
+    joined_subtask_count = db.Column(db.Integer, nullable=False, default=0)
+    message_count = db.Column(db.Integer, nullable=False, default=0)
+    last_activity_at = db.Column(db.DateTime)
+    # set for the tasks of a batch and their subtasks, the state only for the
+    # tasks that were submitted, see ingest_tasks and update_batch
+    batch_id = db.Column(db.Integer, db.ForeignKey("batch.id"))
+    batch_status = db.Column(db.String(16))
+    # whether the title goes into the search index, not stored
+    searchable = True
+
+    @property
+    def status(self):
+        if self.is_complete:
+            return "complete"
+        return "open" if self.is_open else "closed"
+
+    @property
+    def subtask_count(self):
+        return self.open_subtask_count + self.complete_subtask_count
 
     def __repr__(self):
         result = f"Task title:{self.title}\n"
 
         for discussion in self.discussion:
-            result += str(discussion)
+            result += discussion.render(task=self)
         return result
 
-    def add_message(self, user_id, message_text):
-        message = TaskDiscussion(task_id=self.id, user_id=user_id, message=message_text)
+    def add_message(
+        self, user_id, message_text, artifact_digest=None, searchable=True
+    ):
+        message = TaskDiscussion(
+            task_id=self.id,
+            user_id=user_id,
+            message=message_text,
+            artifact_digest=artifact_digest,
+            searchable=searchable,
+        )
         db.session.add(message)
+        self.count_message()
         db.session.commit()
         # Publish a message to the task's pubsub topic
         user_ids_to_notify = [self.client_id, self.worker_id]
@@ -85,6 +203,43 @@ class Task(db.Model):
         user_ids_to_notify.remove(user_id)
         pub.sendMessage("tasks", task_id=self.id, user_ids=user_ids_to_notify)
 
+    def count_message(self):
+        """Update the rollups for a new message on this task, in the current
+        transaction. The counters are incremented in SQL, so concurrent
+        writers do not lose updates."""
+        db.session.execute(
+            db.update(Task)
+            .where(Task.id == self.id)
+            .values(message_count=Task.message_count + 1)
+        )
+        _, touch = task_tree_statements()
+        db.session.execute(touch, {"root_id": self.id, "now": datetime.utcnow()})
+
+    def count_subtasks(self, opened=0, completed=0):
+        """Update this task's subtask rollups by the given deltas"""
+        db.session.execute(
+            db.update(Task)
+            .where(Task.id == self.id)
+            .values(
+                open_subtask_count=Task.open_subtask_count + opened,
+                complete_subtask_count=Task.complete_subtask_count + completed,
+            )
+        )
+
+    def add_tool_output(self, user_id, output):
+        """Post a tool's output. A large output goes to the artifact store,
+        the message only holds its first part and a reference to the rest,
+        see read_artifact_part."""
+        parts = split_tokens(output, app.config["ARTIFACT_EXCERPT_TOKENS"])
+        if len(parts) == 1:
+            return self.add_message(user_id, output)
+        digest = store_artifact(output)
+        self.add_message(
+            user_id,
+            render_artifact_part(digest, parts, 1),
+            artifact_digest=digest,
+        )
+
     def add_subtask(self, title, client_id, worker_id=None):
         if worker_id is not None:
             subtask = Task(
@@ -92,31 +247,1292 @@ class Task(db.Model):
                 client_id=client_id,
                 worker_id=worker_id,
                 parent_task_id=self.id,
+                batch_id=self.batch_id,
             )
         else:
-            subtask = Task(title=title, client_id=client_id, parent_task_id=self.id)
+            subtask = Task(
+                title=title,
+                client_id=client_id,
+                parent_task_id=self.id,
+                batch_id=self.batch_id,
+            )
         db.session.add(subtask)
+        self.count_subtasks(opened=1)
         db.session.commit()
+        if worker_id is not None:
+            # let the worker start on the subtask
+            pub.sendMessage("tasks", task_id=subtask.id, user_ids=[worker_id])
         return subtask
 
+    def add_subtasks(self, titles, client_id, worker_ids):
+        """Create several subtasks in one transaction, then notify their
+        workers so they are worked on concurrently"""
+        subtasks = [
+            Task(
+                title=title,
+                client_id=client_id,
+                worker_id=worker_id,
+                parent_task_id=self.id,
+                batch_id=self.batch_id,
+            )
+            for title, worker_id in zip(titles, worker_ids)
+        ]
+        db.session.add_all(subtasks)
+        self.count_subtasks(opened=len(subtasks))
+        db.session.commit()
+        for subtask in subtasks:
+            pub.sendMessage("tasks", task_id=subtask.id, user_ids=[subtask.worker_id])
+        return subtasks
+
+    def mark_complete(self):
+        # conditional, so that a task completed twice at once counts once
+        completed = db.session.execute(
+            db.update(Task)
+            .where(Task.id == self.id, Task.is_complete.is_(False))
+            .values(is_complete=True, is_open=False)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if completed and self.parent_task is not None:
+            self.parent_task.count_subtasks(
+                opened=-1 if self.is_open else 0, completed=1
+            )
+        self.is_complete = True
+        self.is_open = False
+        db.session.commit()
+        if self.parent_task is not None:
+            self.parent_task.join_subtasks()
+
+    def join_subtasks(self):
+        """Once every subtask is complete, post their results to this task and
+        wake up its worker to act on them.
+
+        Siblings completing at the same time all call this. The join is
+        claimed with a conditional UPDATE of the rollups, so only one of them
+        posts the results, and subtasks added later get a join of their own
+        with only their results. A join happens when all subtasks are
+        complete, so the ones joined before are the first by id.
+        """
+        joined = db.session.scalar(
+            db.select(Task.joined_subtask_count).where(Task.id == self.id)
+        )
+        claimed = db.session.execute(
+            db.update(Task)
+            .where(
+                Task.id == self.id,
+                Task.open_subtask_count == 0,
+                Task.complete_subtask_count > Task.joined_subtask_count,
+                Task.joined_subtask_count == joined,
+            )
+            .values(joined_subtask_count=Task.complete_subtask_count)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if not claimed:
+            db.session.rollback()
+            return
+        subtasks = db.session.scalars(
+            db.select(Task)
+            .where(Task.parent_task_id == self.id)
+            .order_by(Task.id)
+            .offset(joined)
+        ).all()
+        # the last message of each subtask's worker, in one query
+        last_message_ids = (
+            db.select(db.func.max(TaskDiscussion.id))
+            .join(Task, Task.id == TaskDiscussion.task_id)
+            .where(
+                Task.id.in_([subtask.id for subtask in subtasks]),
+                TaskDiscussion.user_id == Task.worker_id,
+            )
+            .group_by(TaskDiscussion.task_id)
+        )
+        last_messages = dict(
+            db.session.execute(
+                db.select(TaskDiscussion.task_id, TaskDiscussion.message).where(
+                    TaskDiscussion.id.in_(last_message_ids)
+                )
+            ).all()
+        )
+        new = " new" if joined else ""
+        results = f"All {len(subtasks)}{new} subtasks are complete.\n"
+        for subtask in subtasks:
+            result = last_messages.get(subtask.id, "(no result)")
+            results += f"\n## {subtask.title}\n{result}\n"
+        message = TaskDiscussion(
+            task_id=self.id, user_id=self.worker_id, message=results
+        )
+        db.session.add(message)
+        self.count_message()
+        db.session.commit()
+        pub.sendMessage("tasks", task_id=self.id, user_ids=[self.worker_id])
+
 
 class TaskDiscussion(db.Model):
+    __table_args__ = (
+        # a task's messages are loaded and paginated by id
+        db.Index("ix_task_discussion_task_id_id", "task_id", "id"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     task_id = db.Column(db.Integer, db.ForeignKey("task.id"), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    # an excerpt when the full text is in the artifact store
     message = db.Column(db.Text, nullable=False)
+    artifact_digest = db.Column(db.String(64), db.ForeignKey("artifact.digest"))
     timestamp = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    user = db.relationship("User", lazy=True)
+    # whether the message goes into the search index, not stored
+    searchable = True
 
     def __repr__(self):
-        username = User.query.get(self.user_id).username
+        return self.render(task=self.task)
+
+    @property
+    def full_message(self):
+        """The full text, loaded from the artifact store on first use"""
+        if self.artifact_digest is None:
+            return self.message
+        return load_artifact(self.artifact_digest)
+
+    def render(self, task):
+        """Format the message, resolving the role from an already loaded task"""
         # determine Role, can be client, worker, or other
-        if self.user_id == Task.query.get(self.task_id).client_id:
+        if self.user_id == task.client_id:
             role = "Client"
-        elif self.user_id == Task.query.get(self.task_id).worker_id:
+        elif self.user_id == task.worker_id:
             role = "Worker"
         else:
             role = None
-        return f"{self.timestamp} : {username} ({role}) : {self.message}\n"
+        return f"{self.timestamp} : {self.user.username} ({role}) : {self.message}\n"
+
+
+def task_tree_cte(up=False):
+    """Recursive CTE of (id, parent_task_id, depth) for the task given as the
+    "root_id" parameter and its descendants, or its ancestors with up=True"""
+    tree = (
+        db.select(Task.id, Task.parent_task_id, db.literal(0).label("depth"))
+        .where(Task.id == db.bindparam("root_id"))
+        .cte(f"task_tree_{'up' if up else 'down'}", recursive=True)
+    )
+    node = db.aliased(Task)
+    if up:
+        step = node.id == tree.c.parent_task_id
+    else:
+        step = node.parent_task_id == tree.c.id
+    return tree.union_all(
+        db.select(node.id, node.parent_task_id, tree.c.depth + 1).where(step)
+    )
+
+
+@cache
+def task_tree_statements():
+    """(load subtree, touch ancestors) statements, built once on first use
+    since building them costs more than running them"""
+    subtree = task_tree_cte()
+    load = (
+        db.select(Task, subtree.c.depth)
+        .join(subtree, Task.id == subtree.c.id)
+        .order_by(subtree.c.depth, Task.id)
+        .limit(db.bindparam("max_nodes"))
+    )
+    ancestors = task_tree_cte(up=True)
+    touch = (
+        db.update(Task)
+        .where(Task.id.in_(db.select(ancestors.c.id)))
+        .values(last_activity_at=db.bindparam("now"))
+        .execution_options(synchronize_session=False)
+    )
+    return load, touch
+
+
+class TaskNode(object):
+    """A task with its loaded subtasks, see load_task_tree"""
+
+    def __init__(self, task, depth):
+        self.task = task
+        self.depth = depth
+        self.children = []
+
+    def walk(self):
+        """This node and its descendants, depth first"""
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+
+def load_task_tree(task_id, max_nodes=None):
+    """Load a task and its subtree in one query, returning the root TaskNode.
+
+    Subtasks are ordered by creation. Only the shallowest max_nodes nodes
+    are loaded, TASK_TREE_MAX_NODES by default.
+    """
+    if max_nodes is None:
+        max_nodes = app.config["TASK_TREE_MAX_NODES"]
+    nodes = {}
+    root = None
+    load, _ = task_tree_statements()
+    rows = db.session.execute(load, {"root_id": task_id, "max_nodes": max_nodes})
+    for task, depth in rows:
+        node = nodes[task.id] = TaskNode(task, depth)
+        if depth == 0:
+            root = node
+        elif task.parent_task_id in nodes:
+            nodes[task.parent_task_id].children.append(node)
+    return root
+
+
+def render_task_tree(root):
+    """The subtasks of a tree as an indented text outline"""
+    lines = []
+    for node in root.walk():
+        if node is root:
+            continue
+        task = node.task
+        indent = "  " * (node.depth - 1)
+        line = f"{indent}- [{task.status}] {task.title} ({task.message_count} messages"
+        if task.subtask_count:
+            line += (
+                f", {task.complete_subtask_count}/{task.subtask_count}"
+                " subtasks complete"
+            )
+        lines.append(line + ")\n")
+    return "".join(lines)
+
+
+def backfill_task_rollups():
+    """Recompute every task's rollups from scratch, e.g. after migrate.py
+    added the columns to an existing database"""
+    child = db.aliased(Task)
+    message = db.aliased(TaskDiscussion)
+    db.session.execute(
+        db.update(Task).values(
+            open_subtask_count=db.select(db.func.count(child.id))
+            .where(child.parent_task_id == Task.id, child.is_open)
+            .scalar_subquery(),
+            complete_subtask_count=db.select(db.func.count(child.id))
+            .where(child.parent_task_id == Task.id, child.is_complete)
+            .scalar_subquery(),
+            message_count=db.select(db.func.count(message.id))
+            .where(message.task_id == Task.id)
+            .scalar_subquery(),
+            # own messages only, activity in subtrees is picked up from here on
+            last_activity_at=db.select(db.func.max(message.timestamp))
+            .where(message.task_id == Task.id)
+            .scalar_subquery(),
+        ),
+        execution_options={"synchronize_session": False},
+    )
+    db.session.commit()
+
+
+class Artifact(db.Model):
+    """A large tool output, compressed and stored once per content hash"""
+
+    # sha256 of the UTF-8 text
+    digest = db.Column(db.String(64), primary_key=True)
+    # zlib compressed UTF-8 text
+    content = db.Column(db.LargeBinary, nullable=False)
+    # uncompressed size in bytes
+    size = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+# Recently expanded artifacts, they never change
+artifact_texts = MemoryCache(max_entries=64)
+
+
+def store_artifact(text):
+    """Add text to the artifact store in the current session and return its
+    digest. Storing the same text again, even concurrently, is a no-op."""
+    data = text.encode("utf-8")
+    digest = hashlib.sha256(data).hexdigest()
+    values = {
+        "digest": digest,
+        "content": zlib.compress(data),
+        "size": len(data),
+        "created_at": datetime.utcnow(),
+    }
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        insert = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}[dialect]
+        db.session.execute(insert(Artifact).values(values).on_conflict_do_nothing())
+    elif db.session.get(Artifact, digest) is None:
+        db.session.add(Artifact(**values))
+    return digest
+
+
+def load_artifact(digest):
+    text = artifact_texts.get(digest)
+    if text is None:
+        artifact = db.session.get(Artifact, digest)
+        text = zlib.decompress(artifact.content).decode("utf-8")
+        artifact_texts.set(digest, text)
+    return text
+
+
+# Length of the artifact references shown to the AI, see render_artifact_part
+ARTIFACT_REF_LENGTH = 12
+
+
+def render_artifact_part(digest, parts, number):
+    """A part of an artifact as a message, telling the AI how to read on"""
+    ref = digest[:ARTIFACT_REF_LENGTH]
+    if number < len(parts):
+        note = f"READ_MORE({ref} {number + 1}) reads on"
+    else:
+        note = "the end"
+    return f"{parts[number - 1]}\n[part {number} of {len(parts)}, {note}]\n"
+
+
+def read_artifact_part(task, argument):
+    """The part of an artifact of the task that a READ_MORE(REF PART) action
+    asks for, as a message for the AI"""
+    ref, _, number = argument.strip().partition(" ")
+    try:
+        number = int(number or 2)
+    except ValueError:
+        return f"READ_MORE({argument}): the part must be a number."
+    # only artifacts posted on this task, references are digest prefixes
+    digest = None
+    if re.fullmatch(r"[0-9a-f]+", ref):
+        digest = db.session.scalar(
+            db.select(TaskDiscussion.artifact_digest)
+            .where(
+                TaskDiscussion.task_id == task.id,
+                TaskDiscussion.artifact_digest.startswith(ref),
+            )
+            .limit(1)
+        )
+    if digest is None:
+        return f"READ_MORE({argument}): no tool output {ref} in this task."
+    parts = split_tokens(load_artifact(digest), app.config["ARTIFACT_EXCERPT_TOKENS"])
+    if not 1 <= number <= len(parts):
+        return f"READ_MORE({argument}): {ref} only has {len(parts)} parts."
+    return render_artifact_part(digest, parts, number)
+
+
+class SearchEntry(db.Model):
+    """A task title or discussion message in the full-text search index.
+
+    Entries are added as tasks and messages are inserted, see index_task and
+    index_message. Their text is matched by an FTS5 table on SQLite and by a
+    GIN index of its tsvector on PostgreSQL, both created with this table.
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    task_id = db.Column(db.Integer, db.ForeignKey("task.id"), nullable=False)
+    # None for the task title
+    message_id = db.Column(db.Integer, db.ForeignKey("task_discussion.id"))
+    body = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+# An external content FTS5 table reads the text from search_entry, the
+# triggers keep its index in step with the rows
+for statement in (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS search_entry_fts USING fts5("
+    "body, content='search_entry', content_rowid='id', "
+    "tokenize='porter unicode61')",
+    "CREATE TRIGGER IF NOT EXISTS search_entry_insert AFTER INSERT ON "
+    "search_entry BEGIN INSERT INTO search_entry_fts(rowid, body) "
+    "VALUES (new.id, new.body); END",
+    "CREATE TRIGGER IF NOT EXISTS search_entry_delete AFTER DELETE ON "
+    "search_entry BEGIN INSERT INTO search_entry_fts(search_entry_fts, rowid, "
+    "body) VALUES ('delete', old.id, old.body); END",
+):
+    db.event.listen(
+        SearchEntry.__table__,
+        "after_create",
+        db.DDL(statement).execute_if(dialect="sqlite"),
+    )
+db.event.listen(
+    SearchEntry.__table__,
+    "before_drop",
+    db.DDL("DROP TABLE IF EXISTS search_entry_fts").execute_if(dialect="sqlite"),
+)
+db.event.listen(
+    SearchEntry.__table__,
+    "after_create",
+    db.DDL(
+        "CREATE INDEX ix_search_entry_document ON search_entry "
+        "USING gin (to_tsvector('english', body))"
+    ).execute_if(dialect="postgresql"),
+)
+
+# Must be written exactly as in the index for PostgreSQL to use it
+TEXT_SEARCH_CONFIG = db.literal_column("'english'")
+SEARCH_MAX_TERMS = 16
+
+
+@db.event.listens_for(Task, "after_insert")
+def index_task(mapper, connection, task):
+    if not task.searchable:
+        return
+    connection.execute(
+        db.insert(SearchEntry.__table__).values(task_id=task.id, body=task.title)
+    )
+
+
+@db.event.listens_for(TaskDiscussion, "after_insert")
+def index_message(mapper, connection, message):
+    # a message that repeats others, e.g. recalled search results, would
+    # crowd out the originals, and bulk inserts index in bulk
+    if not message.searchable:
+        return
+    connection.execute(
+        db.insert(SearchEntry.__table__).values(
+            task_id=message.task_id,
+            message_id=message.id,
+            body=message.message,
+            created_at=message.timestamp,
+        )
+    )
+
+
+def backfill_search_index():
+    """Index every task and message from scratch, e.g. after migrate.py
+    created the search index in an existing database"""
+    table = SearchEntry.__table__
+    db.session.execute(db.delete(table))
+    db.session.execute(
+        db.insert(table).from_select(
+            ["task_id", "body", "created_at"],
+            db.select(Task.id, Task.title, db.literal(datetime.utcnow())),
+        )
+    )
+    db.session.execute(
+        db.insert(table).from_select(
+            ["task_id", "message_id", "body", "created_at"],
+            db.select(
+                TaskDiscussion.task_id,
+                TaskDiscussion.id,
+                TaskDiscussion.message,
+                TaskDiscussion.timestamp,
+            ),
+        )
+    )
+    db.session.commit()
+
+
+def search_terms(query):
+    """The words of a query, safe to pass to any of the search backends"""
+    return re.findall(r"\w+", query.lower())[:SEARCH_MAX_TERMS]
+
+
+def search_entries(query, task_ids, limit, offset=0, match_all=True):
+    """Search the index within the tasks selected by task_ids, best match
+    first. Returns (entry, task title, snippet) rows, the snippet marking
+    the matched words with [brackets]. Every word must match unless
+    match_all is False.
+    """
+    terms = search_terms(query)
+    if not terms:
+        return []
+    dialect = db.session.get_bind().dialect.name
+    statement = db.select(SearchEntry, Task.title).join(
+        Task, Task.id == SearchEntry.task_id
+    )
+    if dialect == "sqlite":
+        fts = db.table("search_entry_fts", db.column("rowid"))
+        document = db.literal_column("search_entry_fts")
+        expression = (" " if match_all else " OR ").join(f'"{t}"' for t in terms)
+        statement = (
+            statement.add_columns(db.func.snippet(document, 0, "[", "]", "...", 16))
+            .join(fts, fts.c.rowid == SearchEntry.id)
+            .where(document.op("MATCH")(expression))
+            .order_by(db.func.bm25(document))
+        )
+    elif dialect == "postgresql":
+        document = db.func.to_tsvector(TEXT_SEARCH_CONFIG, SearchEntry.body)
+        tsquery = db.func.to_tsquery(
+            TEXT_SEARCH_CONFIG, (" & " if match_all else " | ").join(terms)
+        )
+        statement = (
+            statement.add_columns(
+                db.func.ts_headline(
+                    TEXT_SEARCH_CONFIG,
+                    SearchEntry.body,
+                    tsquery,
+                    "StartSel=[, StopSel=], MinWords=8, MaxWords=16",
+                )
+            )
+            .where(document.op("@@")(tsquery))
+            .order_by(db.func.ts_rank(document, tsquery).desc())
+        )
+    else:
+        # no full-text index, scan and show the newest matches first
+        matches = [SearchEntry.body.ilike(f"%{term}%") for term in terms]
+        statement = statement.add_columns(
+            db.func.substr(SearchEntry.body, 1, 120)
+        ).where(db.and_(*matches) if match_all else db.or_(*matches))
+    statement = (
+        statement.where(SearchEntry.task_id.in_(task_ids))
+        .order_by(SearchEntry.id.desc())
+        .limit(limit)
+        .offset(offset)
+    )
+    return db.session.execute(statement).all()
+
+
+def user_task_ids(user_id):
+    """Tasks the user may open, as the client or worker"""
+    return db.select(Task.id).where(
+        db.or_(Task.client_id == user_id, Task.worker_id == user_id)
+    )
+
+
+def related_task_ids(task_id):
+    """The other tasks that the client of task_id's root task asked for, with
+    all their subtasks"""
+    ancestors = task_tree_cte(up=True)
+    root_client_id = db.session.scalar(
+        db.select(Task.client_id)
+        .join(ancestors, Task.id == ancestors.c.id)
+        .where(Task.parent_task_id.is_(None)),
+        {"root_id": task_id},
+    )
+    tasks = (
+        db.select(Task.id)
+        .where(Task.client_id == root_client_id, Task.parent_task_id.is_(None))
+        .cte("client_tasks", recursive=True)
+    )
+    child = db.aliased(Task)
+    tasks = tasks.union_all(
+        db.select(child.id).where(child.parent_task_id == tasks.c.id)
+    )
+    return db.select(tasks.c.id).where(tasks.c.id != task_id)
+
+
+def recall_messages(task, query):
+    """Messages and task titles of the client's other tasks that match the
+    query, as a message for an AI, which already sees the task's own"""
+    rows = search_entries(
+        query,
+        related_task_ids(task.id),
+        limit=app.config["SEARCH_RECALL_RESULTS"],
+        match_all=False,
+    )
+    if not rows:
+        return f"Recall({query}): no earlier messages match."
+    lines = [f"Recall({query}), the best matches in earlier tasks:"]
+    for entry, title, snippet in rows:
+        source = "task title" if entry.message_id is None else "message"
+        lines.append(f"- [{title}] {source}: {snippet}")
+    return "\n".join(lines)
+
+
+class TaskSummary(db.Model):
+    """Rolling summary of the oldest messages of a task discussion"""
+
+    task_id = db.Column(db.Integer, db.ForeignKey("task.id"), primary_key=True)
+    summary = db.Column(db.Text, nullable=False)
+    # messages up to and including this id are covered by the summary
+    through_message_id = db.Column(db.Integer, nullable=False)
+
+
+class LastObservation(db.Model):
+    """Hash of the observation an AI user last acted on for a task"""
+
+    task_id = db.Column(db.Integer, db.ForeignKey("task.id"), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    digest = db.Column(db.String(64), nullable=False)
+    decided_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+# Rendered discussion lines per task, see build_observation
+observation_history = MemoryCache(max_entries=1024)
+
+
+def load_history(task, through_message_id):
+    """The rendered lines of the task's messages after the summary.
+
+    Lines are memoized per task and only messages newer than the last
+    rendered one are loaded and rendered, so the history of a task grows by
+    appending and its rendering is byte identical from one loop to the
+    next. The memo is dropped when the summary moves or the task's roles
+    change, and rebuilt when a message landed behind it (ids committed out
+    of order).
+    """
+    roles = (task.client_id, task.worker_id)
+    entry = observation_history.get(task.id)
+    if entry is not None and (
+        entry["through_message_id"] != through_message_id or entry["roles"] != roles
+    ):
+        entry = None
+    if entry is not None:
+        seen = db.session.scalar(
+            db.select(db.func.count(TaskDiscussion.id)).where(
+                TaskDiscussion.task_id == task.id,
+                TaskDiscussion.id > through_message_id,
+                TaskDiscussion.id <= entry["last_message_id"],
+            )
+        )
+        if seen != len(entry["lines"]):
+            entry = None
+    if entry is None:
+        entry = {
+            "through_message_id": through_message_id,
+            "roles": roles,
+            "last_message_id": through_message_id,
+            "message_ids": [],
+            "lines": [],
+            "tokens": 0,
+        }
+    messages = (
+        TaskDiscussion.query.options(db.joinedload(TaskDiscussion.user))
+        .filter(
+            TaskDiscussion.task_id == task.id,
+            TaskDiscussion.id > entry["last_message_id"],
+        )
+        .order_by(TaskDiscussion.id)
+        .all()
+    )
+    if messages:
+        limit = app.config["OBSERVATION_MESSAGE_TOKEN_LIMIT"]
+        new_lines = [
+            truncate_to_tokens(message.render(task=task), limit)
+            for message in messages
+        ]
+        # a new entry, other threads may still hold the previous one
+        entry = dict(
+            entry,
+            last_message_id=messages[-1].id,
+            message_ids=entry["message_ids"] + [message.id for message in messages],
+            lines=entry["lines"] + new_lines,
+            tokens=entry["tokens"] + sum(count_tokens(line) for line in new_lines),
+        )
+    observation_history.set(task.id, entry)
+    return entry["message_ids"], entry["lines"], entry["tokens"]
+
+
+def build_observation(task_id, with_tree=False):
+    """Render a task for an OODA observation within a token budget.
+
+    Only messages newer than the task's rolling summary and the memoized
+    history (see load_history) are loaded, together with their authors, so
+    the number of queries is constant. Oversized messages (e.g. fetched
+    pages) are truncated. When the recent messages no longer fit
+    OBSERVATION_TOKEN_BUDGET, the oldest are folded into the summary until
+    the rest fits in half the budget, so the summary is only recomputed once
+    in a while and never from scratch. In between, each observation extends
+    the previous one, which keeps the prompts' prefix stable.
+
+    with_tree appends the task's subtask tree with its rollups, loaded in one
+    query, after the discussion so it does not break the stable prefix.
+    """
+    task = db.session.get(Task, task_id, populate_existing=True)
+    task_summary = db.session.get(TaskSummary, task_id)
+    through_message_id = task_summary.through_message_id if task_summary else 0
+    summary = task_summary.summary if task_summary else ""
+    message_ids, lines, tokens = load_history(task, through_message_id)
+
+    header = f"Task title:{task.title}\n"
+    budget = (
+        app.config["OBSERVATION_TOKEN_BUDGET"]
+        - count_tokens(header)
+        - count_tokens(SUMMARY_HEADING)
+    )
+    summary_budget = app.config["OBSERVATION_SUMMARY_TOKEN_BUDGET"]
+    if tokens > budget - count_tokens(summary):
+        older, lines = split_window(lines, (budget - summary_budget) // 2)
+        if older:
+            summary = summarize(summary, older, summary_budget)
+            if task_summary is None:
+                task_summary = TaskSummary(task_id=task_id)
+                db.session.add(task_summary)
+            task_summary.summary = summary
+            task_summary.through_message_id = message_ids[len(older) - 1]
+            db.session.commit()
+            observation_history.set(
+                task_id,
+                {
+                    "through_message_id": task_summary.through_message_id,
+                    "roles": (task.client_id, task.worker_id),
+                    "last_message_id": message_ids[-1],
+                    "message_ids": message_ids[len(older) :],
+                    "lines": lines,
+                    "tokens": sum(count_tokens(line) for line in lines),
+                },
+            )
+    observation = render_observation(header, summary, lines)
+    if with_tree:
+        tree = render_task_tree(load_task_tree(task_id))
+        if tree:
+            observation += f"\nSubtasks:\n{tree}"
+    return observation
+
+
+class Job(db.Model):
+    """A durable unit of AI work: let the listed users react to a task"""
+
+    id = db.Column(db.Integer, primary_key=True)
+    task_id = db.Column(
+        db.Integer, db.ForeignKey("task.id"), nullable=False, index=True
+    )
+    # comma separated user ids to run the AI handlers for
+    user_ids = db.Column(db.String(128), nullable=False)
+    # one of "queued", "running", "done", "failed", or "superseded" when a
+    # job for the same task and users ran in its place
+    status = db.Column(db.String(16), nullable=False, default="queued", index=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # not claimed before this time, pushed back by every new wake-up
+    run_after = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    # renewed while a worker runs the job, see heartbeat_jobs
+    heartbeat_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f"<Job {self.id} task:{self.task_id} {self.status}>"
+
+    @property
+    def user_id_list(self):
+        return [int(user_id) for user_id in self.user_ids.split(",") if user_id]
+
+
+def enqueue_job(task_id, user_ids):
+    """Queue a job per user in its own transaction, debouncing wake-ups.
+
+    A user that already has a queued job for the task gets no second one.
+    Its job is pushed back by AI_WAKEUP_DEBOUNCE seconds instead, so a burst
+    of messages leads to one loop on the final observation. The push back
+    stops AI_WAKEUP_MAX_DELAY seconds after the job was queued, so a busy
+    task is not starved.
+    """
+    now = datetime.utcnow()
+    run_after = now + timedelta(seconds=app.config["AI_WAKEUP_DEBOUNCE"])
+    latest = now - timedelta(seconds=app.config["AI_WAKEUP_MAX_DELAY"])
+    with session_scope() as session:
+        for user_id in {user_id for user_id in user_ids if user_id is not None}:
+            # conditional on the status, a job claimed meanwhile is left alone
+            # and the new wake-up gets a job of its own
+            debounced = session.execute(
+                db.update(Job)
+                .where(
+                    Job.task_id == task_id,
+                    Job.user_ids == str(user_id),
+                    Job.status == "queued",
+                    Job.created_at > latest,
+                )
+                .values(run_after=run_after)
+            ).rowcount
+            if not debounced:
+                session.add(
+                    Job(task_id=task_id, user_ids=str(user_id), run_after=run_after)
+                )
+
+
+def heartbeat_jobs(job_ids):
+    """Renew the lease of the jobs a worker pool is running, if any, then
+    requeue the jobs whose lease ran out. Called every AI_JOB_LEASE / 3."""
+    if job_ids:
+        db.session.execute(
+            db.update(Job)
+            .where(Job.id.in_(job_ids), Job.status == "running")
+            .values(heartbeat_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+    requeue_expired_jobs()
+
+
+def requeue_expired_jobs():
+    """Queue running jobs again whose lease ran out, because their worker
+    died (a crash, a kill, a reloader restart) and stopped renewing it.
+    Jobs out of attempts fail instead. Returns the number of jobs touched."""
+    expired = db.func.coalesce(Job.heartbeat_at, Job.started_at) < (
+        datetime.utcnow() - timedelta(seconds=app.config["AI_JOB_LEASE"])
+    )
+    out_of_attempts = Job.attempts >= app.config["AI_JOB_MAX_ATTEMPTS"]
+    touched = 0
+    for condition, values in (
+        (out_of_attempts, {"status": "failed", "finished_at": datetime.utcnow()}),
+        (~out_of_attempts, {"status": "queued"}),
+    ):
+        touched += db.session.execute(
+            db.update(Job)
+            .where(Job.status == "running", expired, condition)
+            .values(error="The worker running the job was lost", **values)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+    db.session.commit()
+    return touched
+
+
+def claim_next_job():
+    """Atomically mark the oldest runnable job as running and return its id.
+
+    A job is runnable when its debounce delay is over and no other job of the
+    same task is running, which keeps the jobs of a task strictly ordered
+    while different tasks proceed in parallel. The claim locks the task row
+    (skipping tasks another worker is claiming a job of), then is a single
+    conditional UPDATE, so that concurrent workers (threads or processes)
+    can never claim the same job twice, nor two jobs of the same task. Other
+    queued jobs for the same task and users are superseded by the claimed
+    one, whose observation is built after their wake-ups. Jobs of dead
+    workers are requeued by heartbeat_jobs.
+    """
+    running = db.aliased(Job)
+    task_is_busy = (
+        db.select(running.id)
+        .where(running.task_id == Job.task_id, running.status == "running")
+        .exists()
+    )
+    candidates = db.session.execute(
+        db.select(Job.id, Job.task_id, Job.user_ids)
+        .where(
+            Job.status == "queued",
+            db.or_(Job.run_after.is_(None), Job.run_after <= datetime.utcnow()),
+            ~task_is_busy,
+        )
+        .order_by(Job.id)
+        .limit(8)
+    ).all()
+    for job_id, task_id, user_ids in candidates:
+        # Serializes claims per task. On PostgreSQL under READ COMMITTED the
+        # check in the UPDATE alone lets two workers claim jobs of one task
+        # at the same time. SQLite ignores it, its writers are serialized.
+        locked = db.session.scalar(
+            db.select(Task.id)
+            .where(Task.id == task_id)
+            .with_for_update(skip_locked=True)
+        )
+        if locked is None:
+            db.session.rollback()
+            continue
+        # re-check the task inside the UPDATE, the SELECT above may be stale
+        task_is_still_free = ~(
+            db.select(running.id)
+            .where(running.task_id == task_id, running.status == "running")
+            .exists()
+        )
+        claimed = db.session.execute(
+            db.update(Job)
+            .where(Job.id == job_id, Job.status == "queued", task_is_still_free)
+            .values(
+                status="running",
+                started_at=datetime.utcnow(),
+                heartbeat_at=None,
+                attempts=Job.attempts + 1,
+            )
+        ).rowcount
+        if claimed:
+            db.session.execute(
+                db.update(Job)
+                .where(
+                    Job.task_id == task_id,
+                    Job.user_ids == user_ids,
+                    Job.status == "queued",
+                )
+                .values(status="superseded", finished_at=datetime.utcnow())
+            )
+        db.session.commit()
+        if claimed:
+            return job_id
+    return None
+
+
+def run_job(job_id):
+    """Run the AI handlers for a claimed job and record the outcome"""
+    job = db.session.get(Job, job_id)
+    # attribute the spans recorded while handling the job to its task
+    task_id_token = instrumentation.current_task_id.set(job.task_id)
+    attempt_token = current_attempt.set(job.attempts)
+    try:
+        with instrumentation.span("job"):
+            task = db.session.get(Task, job.task_id)
+            users = User.query.filter(User.id.in_(job.user_id_list)).all()
+            for user in users:
+                if user.username == "managerai":
+                    ai = ManagerAI()
+                    ai.handle_task(task=task, as_user=user)
+                if user.username in app.config["AI_AGENT_USERNAMES"]:
+                    ai = AgentAI()
+                    ai.handle_task(task=task, as_user=user)
+    except Exception as e:
+        db.session.rollback()
+        job = db.session.get(Job, job_id)
+        job.error = repr(e)
+        if job.attempts < app.config["AI_JOB_MAX_ATTEMPTS"]:
+            job.status = "queued"
+        else:
+            job.status = "failed"
+            job.finished_at = datetime.utcnow()
+        db.session.commit()
+        print(f"Job {job_id} failed (attempt {job.attempts}): {e!r}")
+        return
+    finally:
+        instrumentation.current_task_id.reset(task_id_token)
+        current_attempt.reset(attempt_token)
+    job.status = "done"
+    job.error = None
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
+
+
+class Batch(db.Model):
+    """Tasks submitted together to be worked on unattended, see ingest_tasks"""
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(128), nullable=False)
+    client_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    task_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # when the first task was started and when no task was left
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+
+# States of a submitted batch task. A started task is running until it is
+# complete or closed, its AI failed or timed out, or the AI answered and waits
+# for the client, who is not around in a batch.
+BATCH_UNFINISHED = ("pending", "running")
+BATCH_FINISHED = ("answered", "complete", "closed", "failed", "timed_out")
+
+
+def batch_worker_usernames():
+    """The AIs a batch can be assigned to"""
+    return ["managerai"] + app.config["AI_AGENT_USERNAMES"]
+
+
+def parse_task_records(text):
+    """(title, message) pairs from a JSON array or JSON lines.
+
+    Each item is a title, or an object with a "title" and an optional
+    "message", which defaults to the title. Raises ValueError naming the
+    first bad item.
+    """
+    text = text.strip()
+    if text.startswith("["):
+        items = enumerate(json.loads(text), start=1)
+    else:
+        items = []
+        for number, line in enumerate(text.splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                items.append((number, json.loads(line)))
+            except ValueError as e:
+                raise ValueError(f"line {number}: {e}") from None
+    max_length = Task.title.type.length
+    records = []
+    for number, item in items:
+        if isinstance(item, str):
+            item = {"title": item}
+        if not isinstance(item, dict):
+            raise ValueError(f"item {number}: expected a title or an object")
+        title = item.get("title")
+        if not isinstance(title, str) or not title.strip():
+            raise ValueError(f"item {number}: a title is required")
+        if len(title.strip()) > max_length:
+            raise ValueError(f"item {number}: title longer than {max_length}")
+        message = item.get("message") or title
+        if not isinstance(message, str):
+            raise ValueError(f"item {number}: the message must be a string")
+        records.append((title.strip(), message))
+    return records
+
+
+def ingest_tasks(records, client_id, worker_id, name, chunk_size=None):
+    """Create a batch of tasks from (title, message) pairs, committing every
+    chunk_size tasks (INGEST_CHUNK_SIZE by default). Returns the batch.
+
+    Each task gets its message from the client, but no AI job: the tasks are
+    pending until a batch runner starts them, see start_batch_tasks.
+    """
+    chunk_size = chunk_size or app.config["INGEST_CHUNK_SIZE"]
+    batch = Batch(name=name, client_id=client_id, task_count=len(records))
+    db.session.add(batch)
+    db.session.commit()
+    for start in range(0, len(records), chunk_size):
+        chunk = records[start : start + chunk_size]
+        now = datetime.utcnow()
+        tasks = [
+            Task(
+                title=title,
+                client_id=client_id,
+                worker_id=worker_id,
+                batch_id=batch.id,
+                batch_status="pending",
+                message_count=1,
+                last_activity_at=now,
+                searchable=False,
+            )
+            for title, _ in chunk
+        ]
+        db.session.add_all(tasks)
+        # assigns the task ids for the messages
+        db.session.flush()
+        messages = [
+            TaskDiscussion(
+                task_id=task.id,
+                user_id=client_id,
+                message=message,
+                timestamp=now,
+                searchable=False,
+            )
+            for task, (_, message) in zip(tasks, chunk)
+        ]
+        db.session.add_all(messages)
+        db.session.flush()
+        # one multi-row insert instead of the per-row index hooks
+        entries = [
+            {"task_id": task.id, "message_id": None, "body": task.title}
+            for task in tasks
+        ]
+        entries += [
+            {"task_id": m.task_id, "message_id": m.id, "body": m.message}
+            for m in messages
+        ]
+        db.session.execute(db.insert(SearchEntry.__table__), entries)
+        db.session.commit()
+    return batch
+
+
+def start_batch_tasks(batch_id, count):
+    """Start up to count pending tasks of the batch, oldest first, by queueing
+    a job for their workers. Returns the number of tasks started.
+
+    A task's state and its job are committed together, so a task is never
+    left running without a job, and the conditional update keeps concurrent
+    runners from starting the same task twice.
+    """
+    pending = db.session.execute(
+        db.select(Task.id, Task.worker_id)
+        .where(Task.batch_id == batch_id, Task.batch_status == "pending")
+        .order_by(Task.id)
+        .limit(count)
+    ).all()
+    now = datetime.utcnow()
+    started = 0
+    for task_id, worker_id in pending:
+        claimed = db.session.execute(
+            db.update(Task)
+            .where(Task.id == task_id, Task.batch_status == "pending")
+            .values(batch_status="running")
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if claimed:
+            db.session.add(Job(task_id=task_id, user_ids=str(worker_id), run_after=now))
+            started += 1
+    if started:
+        db.session.execute(
+            db.update(Batch)
+            .where(Batch.id == batch_id, Batch.started_at.is_(None))
+            .values(started_at=now)
+        )
+    db.session.commit()
+    return started
+
+
+def update_batch(batch_id, task_timeout):
+    """Move the running tasks of the batch that are done to their final
+    state, and finish the batch when no task is left. Returns the number of
+    submitted tasks by state.
+
+    A task is answered when it has no open subtasks and no queued or running
+    jobs, and a job of its worker finished after the last message anywhere
+    in its subtree. Tasks running for more than task_timeout seconds, e.g.
+    on a failed subtask, time out.
+    """
+    job = db.aliased(Job)
+
+    def has_jobs(*statuses):
+        return (
+            db.select(job.id)
+            .where(job.task_id == Task.id, job.status.in_(statuses))
+            .exists()
+        )
+
+    rows = db.session.execute(
+        db.select(
+            Task.id,
+            Task.is_open,
+            Task.is_complete,
+            Task.open_subtask_count,
+            Task.last_activity_at,
+            has_jobs("failed"),
+            has_jobs("queued", "running"),
+            db.select(db.func.max(job.finished_at))
+            .where(job.task_id == Task.id, job.status == "done")
+            .scalar_subquery(),
+            db.select(db.func.min(job.created_at))
+            .where(job.task_id == Task.id)
+            .scalar_subquery(),
+        ).where(Task.batch_id == batch_id, Task.batch_status == "running")
+    ).all()
+    now = datetime.utcnow()
+    deadline = now - timedelta(seconds=task_timeout)
+    finished = {}
+    for (
+        task_id,
+        is_open,
+        is_complete,
+        open_subtasks,
+        last_activity_at,
+        failed,
+        busy,
+        last_done_at,
+        started_at,
+    ) in rows:
+        if not is_open:
+            status = "complete" if is_complete else "closed"
+        elif failed:
+            status = "failed"
+        elif (
+            not busy
+            and not open_subtasks
+            and last_done_at is not None
+            and (last_activity_at is None or last_done_at >= last_activity_at)
+        ):
+            status = "answered"
+        elif started_at is not None and started_at < deadline:
+            status = "timed_out"
+        else:
+            continue
+        finished.setdefault(status, []).append(task_id)
+    for status, task_ids in finished.items():
+        db.session.execute(
+            db.update(Task)
+            .where(Task.id.in_(task_ids), Task.batch_status == "running")
+            .values(batch_status=status)
+            .execution_options(synchronize_session=False)
+        )
+    counts = batch_counts(batch_id)
+    if not any(counts.get(status) for status in BATCH_UNFINISHED):
+        db.session.execute(
+            db.update(Batch)
+            .where(Batch.id == batch_id, Batch.finished_at.is_(None))
+            .values(finished_at=now)
+        )
+    db.session.commit()
+    return counts
+
+
+def batch_counts(batch_id):
+    """The number of submitted tasks of the batch by state"""
+    return dict(
+        db.session.execute(
+            db.select(Task.batch_status, db.func.count(Task.id))
+            .where(Task.batch_id == batch_id, Task.batch_status.is_not(None))
+            .group_by(Task.batch_status)
+        ).all()
+    )
+
+
+def requeue_batch_jobs(batch_id):
+    """Queue the running jobs of the batch's tasks and subtasks again, for a
+    runner resuming after a crash while no other worker is running.
+    Returns the number of jobs requeued."""
+    requeued = db.session.execute(
+        db.update(Job)
+        .where(
+            Job.status == "running",
+            Job.task_id.in_(db.select(Task.id).where(Task.batch_id == batch_id)),
+        )
+        .values(status="queued", run_after=datetime.utcnow())
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    return requeued
+
+
+def batch_summary(batch, counts):
+    """Progress and throughput of a batch, as a JSON-ready dict"""
+    finished = sum(counts.get(status, 0) for status in BATCH_FINISHED)
+    summary = {
+        "id": batch.id,
+        "name": batch.name,
+        "task_count": batch.task_count,
+        "finished": finished,
+        "counts": counts,
+        "created_at": batch.created_at.isoformat(),
+        "started_at": batch.started_at and batch.started_at.isoformat(),
+        "finished_at": batch.finished_at and batch.finished_at.isoformat(),
+        "tasks_per_minute": None,
+    }
+    if batch.started_at is not None:
+        elapsed = (batch.finished_at or datetime.utcnow()) - batch.started_at
+        seconds = elapsed.total_seconds()
+        summary["elapsed_seconds"] = round(seconds, 1)
+        if seconds > 0:
+            summary["tasks_per_minute"] = round(finished * 60 / seconds, 2)
+    return summary
+
+
+class Span(db.Model):
+    """A timed operation: an OODA phase, a model call, a tool call, a commit"""
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), nullable=False, index=True)
+    task_id = db.Column(db.Integer, db.ForeignKey("task.id"), index=True)
+    started_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow, index=True
+    )
+    duration_ms = db.Column(db.Float, nullable=False)
+    prompt_tokens = db.Column(db.Integer, nullable=False, default=0)
+    completion_tokens = db.Column(db.Integer, nullable=False, default=0)
+    cost = db.Column(db.Float, nullable=False, default=0.0)
+    ok = db.Column(db.Boolean, nullable=False, default=True)
+
+
+# Only commits that wrote something are recorded, not e.g. the empty
+# transactions of idle workers polling for jobs
+@db.event.listens_for(db.session, "after_flush")
+def note_flush(session, flush_context):
+    session.info["wrote"] = True
+
+
+@db.event.listens_for(db.session, "do_orm_execute")
+def note_write(orm_execute_state):
+    if not orm_execute_state.is_select:
+        orm_execute_state.session.info["wrote"] = True
+
+
+@db.event.listens_for(db.session, "after_rollback")
+def forget_writes(session):
+    session.info.pop("wrote", None)
+
+
+@db.event.listens_for(db.session, "before_commit")
+def start_commit_timer(session):
+    session.info["commit_started_at"] = time.perf_counter()
+
+
+@db.event.listens_for(db.session, "after_commit")
+def record_commit_span(session):
+    started_at = session.info.pop("commit_started_at", None)
+    if session.info.pop("wrote", False) and started_at is not None:
+        instrumentation.record_span(
+            "db.commit", (time.perf_counter() - started_at) * 1000
+        )
+
+
+# When this process last deleted expired spans, see flush_spans
+spans_pruned_at = None
+
+
+@app.teardown_appcontext
+def flush_spans(exception=None):
+    """Persist the spans finished so far, outside of the ORM session so
+    that saving them is not itself recorded as a commit. Spans older than
+    METRICS_RETENTION_HOURS are deleted about once an hour."""
+    global spans_pruned_at
+    records = instrumentation.drain()
+    if not records:
+        return
+    now = time.monotonic()
+    prune = spans_pruned_at is None or now - spans_pruned_at >= 3600
+    if prune:
+        spans_pruned_at = now
+    with db.engine.begin() as connection:
+        connection.execute(db.insert(Span), records)
+        if prune:
+            retention = timedelta(hours=app.config["METRICS_RETENTION_HOURS"])
+            connection.execute(
+                db.delete(Span).where(Span.started_at < datetime.utcnow() - retention)
+            )
 
 
 class User(UserMixin, db.Model):
@@ -141,68 +1557,174 @@ class User(UserMixin, db.Model):
         return check_password_hash(self.password_hash, password)
 
 
+def pick_agent_ids(count):
+    """Spread new subtasks over the configured agent accounts, least busy first"""
+    open_tasks = db.func.count(Task.id)
+    agents = db.session.execute(
+        db.select(User.id, open_tasks)
+        .outerjoin(Task, (Task.worker_id == User.id) & Task.is_open)
+        .where(User.username.in_(app.config["AI_AGENT_USERNAMES"]))
+        .group_by(User.id)
+        .order_by(open_tasks, User.id)
+    ).all()
+    agent_ids = [agent_id for agent_id, _ in agents]
+    if not agent_ids:
+        raise ValueError(
+            "No agent accounts to assign subtasks to, create one of the users "
+            f"in AI_AGENT_USERNAMES: {', '.join(app.config['AI_AGENT_USERNAMES'])}"
+        )
+    return [agent_ids[i % len(agent_ids)] for i in range(count)]
+
+
+def observation_digest(ooda_class, observation):
+    return hashlib.sha256(
+        f"{ooda_class.__name__}\n{observation}".encode("utf-8")
+    ).hexdigest()
+
+
+def run_ooda_loop(ai, ooda_class, actions, task, as_user, with_tree=False):
+    """Complete an OODA loop on the task and dispatch the chosen action.
+
+    The loop is skipped when nothing changed since the user's last decision
+    on the task, e.g. after a wake-up without a new message.
+    """
+    seen_id = db.session.scalar(
+        db.select(db.func.max(TaskDiscussion.id)).where(
+            TaskDiscussion.task_id == task.id
+        )
+    )
+    observation = build_observation(task.id, with_tree=with_tree)
+    last = db.session.get(LastObservation, (task.id, as_user.id))
+    digest = observation_digest(ooda_class, observation)
+    if last is not None and last.digest == digest:
+        instrumentation.record_span("ooda.skipped", 0.0)
+        print(f"Observation of task {task.id} unchanged, skipping the loop")
+        return
+    ooda = ooda_class(observation, actions=actions, **ooda_options(task))
+    print(f"OODA: {ooda}")
+    action = actions.parse(ooda.action)
+    if action is None:
+        # ask again for the action only, the decision is still good
+        ooda.retry_action(ooda.action)
+        action = actions.parse(ooda.action)
+    if action is None:
+        raise ValueError(f"No valid action in {ooda.action!r}")
+    print(f"action: {action}")
+    actions.dispatch(ai, task, as_user, action)
+    # remember the observation as the action left it, or the action's own
+    # messages would make every later loop look new. Unless someone else
+    # wrote meanwhile, their message must still wake the AI.
+    after = build_observation(task.id, with_tree=with_tree)
+    others_wrote = db.session.scalar(
+        db.select(TaskDiscussion.id)
+        .where(
+            TaskDiscussion.task_id == task.id,
+            TaskDiscussion.id > (seen_id or 0),
+            TaskDiscussion.user_id != as_user.id,
+        )
+        .limit(1)
+    )
+    if others_wrote is None:
+        digest = observation_digest(ooda_class, after)
+    # a failed loop stores nothing and is retried
+    if last is None:
+        last = LastObservation(task_id=task.id, user_id=as_user.id)
+        db.session.add(last)
+    last.digest = digest
+    last.decided_at = datetime.utcnow()
+    db.session.commit()
+
+
 class AgentAI(object):
     """An AI that takes on small tasks"""
 
+    actions = ActionRegistry()
+
+    @actions.register("MESSAGE_CLIENT")
+    def message_client(self, task, as_user, argument):
+        task.add_message(user_id=as_user.id, message_text=argument)
+
+    @actions.register("SEARCH_WEB")
+    def search_web(self, task, as_user, argument):
+        result = tools.get_organic_search_results(argument)
+        task.add_tool_output(user_id=as_user.id, output=str(result))
+
+    @actions.register("ACCESS_URL")
+    def access_url(self, task, as_user, argument):
+        markdown = tools.get_markdown_from_url(argument)
+        task.add_tool_output(user_id=as_user.id, output=markdown)
+
+    @actions.register("READ_MORE")
+    def read_more(self, task, as_user, argument):
+        task.add_message(
+            user_id=as_user.id, message_text=read_artifact_part(task, argument)
+        )
+
+    @actions.register("CALCULATE_EXPRESSION")
+    def calculate_expression(self, task, as_user, argument):
+        result = tools.calculate_expression(argument)
+        task.add_message(user_id=as_user.id, message_text=f"{argument} = {result}")
+
+    @actions.register("RECALL")
+    def recall(self, task, as_user, argument):
+        task.add_message(
+            user_id=as_user.id,
+            message_text=recall_messages(task, argument),
+            searchable=False,
+        )
+
     def handle_task(self, task, as_user):
         """Given a task, complete an OODA loop on the task"""
-        ooda = AgentOODA(str(task))
-        print(f"OODA: {ooda}")
-        # Parse the action, separating out ACTION_NAME and ARGUMENT
-        action_name = ooda.action.split("(")[0]
-        print(f"action_name: {action_name}")
-        argument = ooda.action.split("(")[1].split(")")[0]
-        print(f"argument: {argument}")
-        if action_name == "MESSAGE_CLIENT":
-            task.add_message(user_id=as_user.id, message_text=argument)
-        elif action_name == "SEARCH_WEB":
-            result = tools.get_organic_search_results(argument)
-            task.add_message(user_id=as_user.id, message_text=str(result))
-        elif action_name == "ACCESS_URL":
-            markdown = tools.get_markdown_from_url(argument)
-            task.add_message(user_id=as_user.id, message_text=markdown)
-        else:
-            raise NotImplementedError(f"Action {action_name} is not implemented for AI")
+        run_ooda_loop(self, AgentOODA, self.actions, task, as_user)
 
 
 class ManagerAI(object):
     """An AI that manages Agent AIs to complete a Client task"""
 
+    worker_actions = ActionRegistry()
+    client_actions = ActionRegistry()
+
+    @worker_actions.register("MESSAGE_CLIENT")
+    @worker_actions.register("CREATE_PLAN")
+    def message_client(self, task, as_user, argument):
+        task.add_message(user_id=as_user.id, message_text=argument)
+
+    @worker_actions.register("CREATE_SUBTASK")
+    def create_subtask(self, task, as_user, argument):
+        if not argument.strip():
+            raise ValueError("CREATE_SUBTASK needs a title")
+        agent_id = pick_agent_ids(1)[0]
+        task.add_subtask(title=argument, client_id=as_user.id, worker_id=agent_id)
+
+    @worker_actions.register("CREATE_SUBTASKS")
+    def create_subtasks(self, task, as_user, argument):
+        titles = [title.strip() for title in argument.split("|") if title.strip()]
+        if not titles:
+            # or the task would wait for subtasks that were never created
+            raise ValueError("CREATE_SUBTASKS needs titles separated by |")
+        task.add_subtasks(
+            titles=titles,
+            client_id=as_user.id,
+            worker_ids=pick_agent_ids(len(titles)),
+        )
+
+    @client_actions.register("MESSAGE_WORKER")
+    def message_worker(self, task, as_user, argument):
+        task.add_message(user_id=as_user.id, message_text=argument)
+
+    @client_actions.register("MARK_TASK_COMPLETE")
+    def mark_task_complete(self, task, as_user, argument):
+        task.mark_complete()
+
     def handle_task_as_worker(self, task, as_user):
         """Given a task, complete an OODA loop on the task"""
-        ooda = ManagerOODA(str(task))
-        print(f"OODA: {ooda}")
-        # Parse the action, separating out ACTION_NAME and ARGUMENT
-        action_name = ooda.action.split("(")[0]
-        print(f"action_name: {action_name}")
-        argument = ooda.action.split("(")[1].split(")")[0]
-        print(f"argument: {argument}")
-        if action_name == "MESSAGE_CLIENT":
-            task.add_message(user_id=as_user.id, message_text=argument)
-        elif action_name == "CREATE_PLAN":
-            task.add_message(user_id=as_user.id, message_text=argument)
-        elif action_name == "CREATE_SUBTASK":
-            # Get the agent AI
-            agent_ai = User.query.filter_by(username="agentai").first()
-            task.add_subtask(
-                title=argument, client_id=as_user.id, worker_id=agent_ai.id
-            )
-        else:
-            raise NotImplementedError(f"Action {action_name} is not implemented for AI")
+        run_ooda_loop(
+            self, ManagerOODA, self.worker_actions, task, as_user, with_tree=True
+        )
 
     def handle_task_as_client(self, task, as_user):
         """Given a task, complete an OODA loop on the task"""
-        ooda = ClientOODA(str(task))
-        print(f"OODA: {ooda}")
-        # Parse the action, separating out ACTION_NAME and ARGUMENT
-        action_name = ooda.action.split("(")[0]
-        print(f"action_name: {action_name}")
-        argument = ooda.action.split("(")[1].split(")")[0]
-        print(f"argument: {argument}")
-        if action_name == "MESSAGE_WORKER":
-            task.add_message(user_id=as_user.id, message_text=argument)
-        else:
-            raise NotImplementedError(f"Action {action_name} is not implemented for AI")
+        run_ooda_loop(self, ClientOODA, self.client_actions, task, as_user)
 
     def handle_task(self, task, as_user):
         # determine if the user is the client or worker
@@ -236,13 +1758,48 @@ def home():
     return render_template("home.html")
 
 
+def user_tasks_page(user_id, status="open", before=None, limit=50):
+    """Newest tasks where the user is client or worker, ids below `before`.
+
+    Instead of one OR query, which cannot use an index for both columns, the
+    client side and worker side are read separately from their own index and
+    merged. Returns (tasks, cursor of the next page or None).
+    """
+    pages = []
+    for column in (Task.client_id, Task.worker_id):
+        query = Task.query.filter(column == user_id)
+        if status == "open":
+            query = query.filter(Task.is_open.is_(True))
+        elif status == "complete":
+            query = query.filter(Task.is_open.is_(False), Task.is_complete.is_(True))
+        if before is not None:
+            query = query.filter(Task.id < before)
+        pages.append(query.order_by(Task.id.desc()).limit(limit + 1).all())
+    merged = sorted(
+        {task.id: task for page in pages for task in page}.values(),
+        key=lambda task: task.id,
+        reverse=True,
+    )
+    if len(merged) > limit:
+        return merged[:limit], merged[limit - 1].id
+    return merged, None
+
+
 @app.route("/tasks")
 @login_required
 def tasks():
-    tasks = Task.query.filter(
-        (Task.client_id == current_user.id) | (Task.worker_id == current_user.id)
-    ).all()
-    return render_template("tasks.html", tasks=tasks)
+    status = request.args.get("status", "open")
+    if status not in ("open", "complete", "all"):
+        abort(400, description="status must be open, complete or all")
+    tasks, next_cursor = user_tasks_page(
+        current_user.id,
+        status=status,
+        before=request.args.get("before", type=int),
+        limit=app.config["TASKS_PER_PAGE"],
+    )
+    return render_template(
+        "tasks.html", tasks=tasks, status=status, next_cursor=next_cursor
+    )
 
 
 @app.route("/login", methods=["GET", "POST"])
@@ -303,7 +1860,208 @@ def task_detail(task_id):
         return redirect(
             url_for("home")
         )  # Redirect to homepage if user isn't client or worker
-    return render_template("task_detail.html", task=task)
+
+    # newest page of messages by default, older pages before a message id
+    per_page = app.config["DISCUSSION_PER_PAGE"]
+    before = request.args.get("before", type=int)
+    query = TaskDiscussion.query.options(db.joinedload(TaskDiscussion.user)).filter(
+        TaskDiscussion.task_id == task.id
+    )
+    if before is not None:
+        query = query.filter(TaskDiscussion.id < before)
+    messages = query.order_by(TaskDiscussion.id.desc()).limit(per_page + 1).all()
+    older_cursor = messages[per_page - 1].id if len(messages) > per_page else None
+    messages = list(reversed(messages[:per_page]))
+
+    # subtasks in creation order, after a subtask id
+    subtasks_after = request.args.get("subtasks_after", type=int)
+    query = Task.query.filter(Task.parent_task_id == task.id)
+    if subtasks_after is not None:
+        query = query.filter(Task.id > subtasks_after)
+    subtasks = query.order_by(Task.id).limit(per_page + 1).all()
+    subtasks_cursor = subtasks[per_page - 1].id if len(subtasks) > per_page else None
+    subtasks = subtasks[:per_page]
+    # the subtrees of the listed subtasks, with their rollups
+    tree = load_task_tree(task.id)
+    nodes = {node.task.id: node for node in tree.walk()}
+
+    return render_template(
+        "task_detail.html",
+        task=task,
+        nodes=nodes,
+        messages=messages,
+        older_cursor=older_cursor,
+        is_latest_page=before is None,
+        subtasks=subtasks,
+        subtasks_cursor=subtasks_cursor,
+    )
+
+
+@app.route("/batches", methods=["POST"])
+@login_required
+def create_batch():
+    """Submit tasks in bulk, a JSON array or JSON lines in the request body.
+
+    The tasks wait for a batch runner (python batch.py run BATCH_ID), which
+    works through them a few at a time.
+    """
+    worker = request.args.get("worker", "managerai")
+    if worker not in batch_worker_usernames():
+        abort(400, description=f"worker must be one of {batch_worker_usernames()}")
+    try:
+        records = parse_task_records(request.get_data(as_text=True))
+    except ValueError as e:
+        abort(400, description=str(e))
+    if not records:
+        abort(400, description="No tasks provided")
+    batch = ingest_tasks(
+        records,
+        client_id=current_user.id,
+        worker_id=User.query.filter_by(username=worker).one().id,
+        name=request.args.get("name") or f"batch of {len(records)} tasks",
+    )
+    summary = batch_summary(batch, batch_counts(batch.id))
+    summary["url"] = url_for("batch_status", batch_id=batch.id)
+    return jsonify(summary), 201
+
+
+@app.route("/batches/<int:batch_id>")
+@login_required
+def batch_status(batch_id):
+    batch = db.get_or_404(Batch, batch_id)
+    if batch.client_id != current_user.id and not current_user.is_admin:
+        abort(403)
+    return jsonify(batch_summary(batch, batch_counts(batch.id)))
+
+
+@app.route("/search")
+@login_required
+def search():
+    """Ranked search over the titles and messages of the user's tasks"""
+    query = request.args.get("q", "").strip()
+    page = max(1, request.args.get("page", 1, type=int))
+    per_page = app.config["SEARCH_RESULTS_PER_PAGE"]
+    results = search_entries(
+        query,
+        user_task_ids(current_user.id),
+        limit=per_page + 1,
+        offset=(page - 1) * per_page,
+    )
+    return render_template(
+        "search.html",
+        query=query,
+        page=page,
+        results=results[:per_page],
+        has_next_page=len(results) > per_page,
+    )
+
+
+@app.route("/tasks/<int:task_id>/messages/<int:message_id>/full")
+@login_required
+def message_full(task_id, message_id):
+    """The full text of a message whose output is in the artifact store"""
+    task = Task.query.get_or_404(task_id)
+    if task.client_id != current_user.id and task.worker_id != current_user.id:
+        abort(403)
+    message = TaskDiscussion.query.filter_by(
+        id=message_id, task_id=task.id
+    ).first_or_404()
+    return Response(message.full_message, mimetype="text/plain")
+
+
+def format_event(event, data, event_id=None):
+    """Format one Server-Sent Event"""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+@app.route("/tasks/<int:task_id>/events")
+@login_required
+def task_events(task_id):
+    """Stream new discussion messages and partial AI output as Server-Sent Events.
+
+    The id of each message event is the message id, so a reconnecting client
+    resumes from the Last-Event-ID header (or the `after` query parameter).
+    """
+    task = Task.query.get_or_404(task_id)
+    if task.client_id != current_user.id and task.worker_id != current_user.id:
+        abort(403)
+    cursor = request.headers.get("Last-Event-ID") or request.args.get("after") or "0"
+    if not re.fullmatch(r"[0-9]+", cursor):
+        abort(400, description="Last-Event-ID and after must be message ids")
+    cursor = int(cursor)
+    watched_task_id = task.id
+    events = queue.Queue()
+
+    # pubsub only keeps weak references, the generator keeps these alive
+    def on_task(task_id, user_ids):
+        if task_id == watched_task_id:
+            events.put(("tasks", None))
+
+    def on_partial(task_id, phase, piece):
+        if task_id == watched_task_id:
+            events.put(("partial", {"phase": phase, "piece": piece}))
+
+    def generate():
+        nonlocal cursor
+        pub.subscribe(on_task, "tasks")
+        pub.subscribe(on_partial, "ooda")
+        try:
+            # send whatever was missed before (re)connecting
+            events.put(("tasks", None))
+            while True:
+                try:
+                    topic, data = events.get(
+                        timeout=app.config["TASK_EVENTS_POLL_INTERVAL"]
+                    )
+                except queue.Empty:
+                    # AI workers in another process do not publish here,
+                    # so check the database on every idle interval too
+                    topic, data = "tasks", None
+                    yield ": keep-alive\n\n"
+                if topic == "partial":
+                    yield format_event("partial", data)
+                    continue
+                messages = (
+                    TaskDiscussion.query.options(db.joinedload(TaskDiscussion.user))
+                    .filter(
+                        TaskDiscussion.task_id == task_id, TaskDiscussion.id > cursor
+                    )
+                    .order_by(TaskDiscussion.id)
+                    .all()
+                )
+                for message in messages:
+                    cursor = message.id
+                    yield format_event(
+                        "message",
+                        {
+                            "id": message.id,
+                            "username": message.user.username,
+                            "message": message.message,
+                            "full_url": url_for(
+                                "message_full", task_id=task_id, message_id=message.id
+                            )
+                            if message.artifact_digest
+                            else None,
+                            "timestamp": message.timestamp.isoformat(),
+                        },
+                        event_id=message.id,
+                    )
+                # release the connection while waiting for the next event
+                db.session.remove()
+        finally:
+            pub.unsubscribe(on_task, "tasks")
+            pub.unsubscribe(on_partial, "ooda")
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.route("/tasks/<int:task_id>/add_message", methods=["POST"])
@@ -320,6 +2078,63 @@ def add_message(task_id):
     return redirect(url_for("task_detail", task_id=task.id))
 
 
+@app.route("/metrics")
+@login_required
+@admin_required
+def metrics():
+    since = datetime.utcnow() - timedelta(hours=app.config["METRICS_WINDOW_HOURS"])
+    # percentiles per span name are picked in SQL from the ranked durations
+    ranked = (
+        db.select(
+            Span.name,
+            Span.duration_ms,
+            db.func.row_number()
+            .over(partition_by=Span.name, order_by=Span.duration_ms)
+            .label("position"),
+            db.func.count().over(partition_by=Span.name).label("count"),
+        )
+        .where(Span.started_at >= since)
+        .subquery()
+    )
+
+    def percentile(percent):
+        position = ranked.c.count * percent // 100 + 1
+        return db.func.max(
+            db.case((ranked.c.position == position, ranked.c.duration_ms))
+        )
+
+    latencies = [
+        row._asdict()
+        for row in db.session.execute(
+            db.select(
+                ranked.c.name,
+                db.func.max(ranked.c.count).label("count"),
+                percentile(50).label("p50"),
+                percentile(95).label("p95"),
+            )
+            .group_by(ranked.c.name)
+            .order_by(ranked.c.name)
+        )
+    ]
+
+    tokens = db.func.sum(Span.prompt_tokens + Span.completion_tokens)
+    top_tasks = db.session.execute(
+        db.select(
+            Task.id,
+            Task.title,
+            db.func.sum(Span.prompt_tokens).label("prompt_tokens"),
+            db.func.sum(Span.completion_tokens).label("completion_tokens"),
+            db.func.sum(Span.cost).label("cost"),
+        )
+        .join(Span, Span.task_id == Task.id)
+        .where(Span.name == "llm.chat")
+        .group_by(Task.id, Task.title)
+        .order_by(tokens.desc())
+        .limit(20)
+    ).all()
+    return render_template("metrics.html", latencies=latencies, top_tasks=top_tasks)
+
+
 @app.route("/users", methods=["GET"])
 @login_required
 @admin_required
@@ -352,5 +2167,29 @@ def create_user():
     return render_template("create_user.html")
 
 
+def start_workers(worker_count=None):
+    """Start a pool of AI workers in this process, AI_WORKER_COUNT of them
+    unless worker_count is given"""
+    from worker import WorkerPool
+
+    if worker_count is None:
+        worker_count = app.config["AI_WORKER_COUNT"]
+    pool = WorkerPool(
+        app,
+        claim=claim_next_job,
+        run=run_job,
+        worker_count=worker_count,
+        poll_interval=app.config["AI_WORKER_POLL_INTERVAL"],
+        heartbeat=heartbeat_jobs,
+        heartbeat_interval=app.config["AI_JOB_LEASE"] / 3,
+    ).start()
+    # wake idle workers as soon as a job is queued in this process
+    pub.subscribe(pool.notify, "tasks")
+    return pool
+
+
 if __name__ == "__main__":
+    # with the debug reloader only the child process serves requests
+    if not app.debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_workers()
     app.run(port=8007)
@@ -0,0 +1,200 @@
+"""Submit tasks in bulk and work through them unattended, e.g.
+
+    python batch.py ingest research.jsonl --client alice --name nightly
+    python batch.py run 3 --concurrency 8
+    python batch.py status 3
+
+The input file is a JSON array or JSON lines, each item a task title or an
+object with a "title" and an optional "message".
+"""
+import argparse
+import json
+import sys
+import time
+
+from app import (
+    BATCH_UNFINISHED,
+    Batch,
+    User,
+    app,
+    batch_counts,
+    batch_summary,
+    batch_worker_usernames,
+    db,
+    ingest_tasks,
+    parse_task_records,
+    requeue_batch_jobs,
+    start_batch_tasks,
+    start_workers,
+    update_batch,
+)
+
+
+class BatchRunner(object):
+    """Keeps up to `concurrency` tasks of a batch in flight until none is left.
+
+    Each round moves finished tasks to their final state and starts pending
+    ones in their place. All progress is in the database, committed every
+    round, so a stopped runner picks up where it left off. The AI jobs are
+    run by any worker pool, `on_start` is called after tasks were started,
+    e.g. to wake a pool.
+    """
+
+    def __init__(
+        self,
+        app,
+        batch_id,
+        concurrency=8,
+        task_timeout=3600,
+        poll_interval=1.0,
+        report_interval=10.0,
+        on_start=None,
+    ):
+        self.app = app
+        self.batch_id = batch_id
+        self.concurrency = concurrency
+        self.task_timeout = task_timeout
+        self.poll_interval = poll_interval
+        self.report_interval = report_interval
+        self.on_start = on_start
+
+    def step(self):
+        """One round, returns the task counts by state"""
+        with self.app.app_context():
+            counts = update_batch(self.batch_id, self.task_timeout)
+            free = self.concurrency - counts.get("running", 0)
+            if free > 0 and counts.get("pending"):
+                if start_batch_tasks(self.batch_id, free) and self.on_start:
+                    self.on_start()
+                counts = batch_counts(self.batch_id)
+        return counts
+
+    def report(self, counts):
+        with self.app.app_context():
+            summary = batch_summary(db.session.get(Batch, self.batch_id), counts)
+        states = ", ".join(
+            f"{count} {state}" for state, count in sorted(counts.items())
+        )
+        rate = summary["tasks_per_minute"]
+        print(
+            f"batch {summary['id']}: {summary['finished']}/{summary['task_count']}"
+            f" finished ({states})"
+            + (f", {rate} tasks/min" if rate is not None else "")
+        )
+        return summary
+
+    def run(self):
+        """Work through the batch, returns its final summary"""
+        reported_at = time.monotonic()
+        while True:
+            counts = self.step()
+            if not any(counts.get(state) for state in BATCH_UNFINISHED):
+                return self.report(counts)
+            if time.monotonic() - reported_at >= self.report_interval:
+                self.report(counts)
+                reported_at = time.monotonic()
+            time.sleep(self.poll_interval)
+
+
+def ingest(args):
+    with open(args.path) as f:
+        records = parse_task_records(f.read())
+    with app.app_context():
+        client = User.query.filter_by(username=args.client).first()
+        if client is None:
+            raise ValueError(f"no user {args.client}")
+        worker = User.query.filter_by(username=args.worker).one()
+        start = time.perf_counter()
+        batch = ingest_tasks(
+            records,
+            client_id=client.id,
+            worker_id=worker.id,
+            name=args.name or args.path,
+            chunk_size=args.chunk_size,
+        )
+        elapsed = time.perf_counter() - start
+        print(
+            f"Created batch {batch.id} with {len(records)} tasks in {elapsed:.1f} s"
+            f" ({len(records) / elapsed:.0f} tasks/s)"
+        )
+
+
+def run(args):
+    pool = None
+    with app.app_context():
+        if args.requeue_running:
+            print(f"Requeued {requeue_batch_jobs(args.batch_id)} running jobs")
+    if args.workers:
+        pool = start_workers(args.workers)
+    runner = BatchRunner(
+        app,
+        args.batch_id,
+        concurrency=args.concurrency,
+        task_timeout=args.task_timeout,
+        report_interval=args.report_interval,
+        on_start=pool.notify if pool else None,
+    )
+    try:
+        summary = runner.run()
+    finally:
+        if pool is not None:
+            pool.stop()
+    print(json.dumps(summary, indent=2))
+
+
+def status(args):
+    with app.app_context():
+        batch = db.session.get(Batch, args.batch_id)
+        if batch is None:
+            raise ValueError(f"no batch {args.batch_id}")
+        print(json.dumps(batch_summary(batch, batch_counts(batch.id)), indent=2))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("ingest", help="create a batch from a file")
+    command.add_argument("path")
+    command.add_argument("--client", required=True, help="username of the client")
+    command.add_argument(
+        "--worker", default="managerai", choices=batch_worker_usernames()
+    )
+    command.add_argument("--name")
+    command.add_argument("--chunk-size", type=int, help="tasks per transaction")
+    command.set_defaults(handler=ingest)
+
+    command = commands.add_parser("run", help="work through a batch")
+    command.add_argument("batch_id", type=int)
+    command.add_argument(
+        "--concurrency", type=int, default=app.config["BATCH_CONCURRENCY"],
+        help="tasks in flight",
+    )
+    command.add_argument(
+        "--workers", type=int, default=app.config["AI_WORKER_COUNT"],
+        help="AI worker threads to run here, 0 when workers run elsewhere",
+    )
+    command.add_argument(
+        "--task-timeout", type=float, default=app.config["BATCH_TASK_TIMEOUT"],
+        help="seconds before a running task is given up",
+    )
+    command.add_argument("--report-interval", type=float, default=10.0)
+    command.add_argument(
+        "--requeue-running", action="store_true",
+        help="retry the jobs a crashed runner left running",
+    )
+    command.set_defaults(handler=run)
+
+    command = commands.add_parser("status", help="show the progress of a batch")
+    command.add_argument("batch_id", type=int)
+    command.set_defaults(handler=status)
+
+    args = parser.parse_args(argv)
+    try:
+        args.handler(args)
+    except ValueError as e:
+        sys.exit(f"error: {e}")
+
+
+if __name__ == "__main__":
+    main()
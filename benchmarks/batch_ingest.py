@@ -0,0 +1,87 @@
+"""Bulk task submission: ingest_tasks, which commits a chunk of tasks and
+their first messages per transaction, against creating the same tasks one
+commit at a time like the /tasks/create form, on a throwaway SQLite file.
+
+Run from the repository root with e.g.
+
+    python -m benchmarks.batch_ingest --tasks 2000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import config
+
+db_path = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+config.DevelopmentConfig.SQLALCHEMY_DATABASE_URI = "sqlite:///" + db_path
+
+from app import (  # noqa: E402
+    SearchEntry,
+    Task,
+    TaskDiscussion,
+    User,
+    app,
+    batch_counts,
+    db,
+    ingest_tasks,
+)
+from setup import create_user  # noqa: E402
+
+
+def one_commit_per_task(records, client_id, worker_id):
+    for title, message in records:
+        task = Task(title=title, client_id=client_id, worker_id=worker_id)
+        db.session.add(task)
+        db.session.commit()
+        db.session.add(
+            TaskDiscussion(task_id=task.id, user_id=client_id, message=message)
+        )
+        db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tasks", type=int, default=2000)
+    parser.add_argument("--chunk-size", type=int, default=None)
+    args = parser.parse_args()
+
+    records = [
+        (f"Nightly research topic {i}", f"Please research topic {i} in depth.")
+        for i in range(args.tasks)
+    ]
+    with app.app_context():
+        db.create_all()
+        create_user("alice", "alice@example.com", "alicepassword")
+        create_user("managerai", "managerai@example.com", "aipassword")
+        client_id = User.query.filter_by(username="alice").one().id
+        worker_id = User.query.filter_by(username="managerai").one().id
+
+        start = time.perf_counter()
+        one_commit_per_task(records, client_id, worker_id)
+        single = time.perf_counter() - start
+
+        start = time.perf_counter()
+        batch = ingest_tasks(
+            records, client_id, worker_id, "benchmark", chunk_size=args.chunk_size
+        )
+        bulk = time.perf_counter() - start
+
+        assert batch_counts(batch.id) == {"pending": args.tasks}
+        # the titles and messages are searchable
+        entries, messages = db.session.execute(
+            db.select(
+                db.func.count(SearchEntry.id), db.func.count(SearchEntry.message_id)
+            )
+            .join(Task, Task.id == SearchEntry.task_id)
+            .where(Task.batch_id == batch.id)
+        ).one()
+        assert (entries, messages) == (2 * args.tasks, args.tasks)
+
+    print(f"one commit per task: {single:.2f} s ({args.tasks / single:.0f} tasks/s)")
+    print(f"ingest_tasks:        {bulk:.2f} s ({args.tasks / bulk:.0f} tasks/s)")
+    print(f"speedup:             {single / bulk:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""End-to-end throughput of the AI loop without OpenAI or SerpAPI.
+
+Client tasks go through ManagerAI -> CREATE_SUBTASK -> AgentAI -> search ->
+result -> MARK_TASK_COMPLETE -> join -> final answer, driven by a scripted fake
+chat backend with configurable latency (behind the real LLM client), a fake
+search provider and a fake fetcher, on a throwaway SQLite database seeded
+through setup.create_user.
+
+Run from the repository root with e.g.
+
+    python -m benchmarks.loop_throughput --tasks 20 --workers 4
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+os.environ["LLM_CACHE"] = "off"
+os.environ["SEARCH_PROVIDER"] = "fake"
+
+import config  # noqa: E402
+
+db_path = os.path.join(tempfile.mkdtemp(), "benchmark.db")
+config.DevelopmentConfig.SQLALCHEMY_DATABASE_URI = "sqlite:///" + db_path
+
+from pubsub import pub  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+import tools  # noqa: E402
+from app import (  # noqa: E402
+    Job,
+    Span,
+    Task,
+    TaskDiscussion,
+    User,
+    app,
+    claim_next_job,
+    db,
+    run_job,
+)
+from prompts.prompts import (  # noqa: E402
+    AgentOODA,
+    ClientOODA,
+    ManagerOODA,
+    get_llm_client,
+)
+from setup import create_user  # noqa: E402
+from worker import WorkerPool  # noqa: E402
+
+FINAL_ANSWER = "FINAL ANSWER"
+
+
+def last_message(prompt):
+    """The last discussion line of the observation embedded in a prompt"""
+    observation = prompt.split("```")[1]
+    lines = [line for line in observation.strip().splitlines() if " : " in line]
+    return lines[-1] if lines else ""
+
+
+def scripted_action(prompt):
+    """Pick the next action from the role (action list) and last message"""
+    last = last_message(prompt)
+    if "MARK_TASK_COMPLETE" in prompt:
+        # the manager acting as the client of a subtask
+        if "Summary:" in last:
+            return "MARK_TASK_COMPLETE()"
+        return "MESSAGE_WORKER(Please summarize what you found.)"
+    if "CREATE_SUBTASK" in prompt:
+        if "subtasks are complete" in last:
+            return f"MESSAGE_CLIENT({FINAL_ANSWER}: see the subtask results.)"
+        return "CREATE_SUBTASK(Research the topic)"
+    # an agent working on a subtask
+    if "Please summarize" in last:
+        return "MESSAGE_CLIENT(Summary: the search found 5 results.)"
+    title = re.search(r"Task title:(.*)", prompt).group(1)
+    return f"SEARCH_WEB({title})"
+
+
+class FakeChatCompletion(object):
+    """Stands in for the chat completion transport with a fixed latency"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+    async def acreate(self, model, messages, stream=False, **params):
+        # runs on the LLM client's event loop, no locking needed
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        prompt = "".join(message["content"] for message in messages)
+        instruction = messages[-1]["content"]
+        if "Respond with only a JSON object" in instruction:
+            text = json.dumps(
+                {"decision": "Take the next step.", "action": scripted_action(prompt)}
+            )
+        elif "### ACT ###" in instruction:
+            text = f"I will now act.\n{scripted_action(prompt)}\nThat is all."
+        else:
+            text = "Decision: take the next step of the plan."
+        if not stream:
+            return {
+                "choices": [{"message": {"content": text}}],
+                "usage": {"prompt_tokens": len(prompt) // 4,
+                          "completion_tokens": 10},
+            }
+
+        async def pieces():
+            for word in re.findall(r"\S+\s*", text):
+                yield {"choices": [{"delta": {"content": word}}]}
+
+        return pieces()
+
+
+class FakeFetcher(object):
+    def __init__(self, latency):
+        self.latency = latency
+
+    def get_markdown(self, url):
+        time.sleep(self.latency)
+        return f"# {url}\n\nSome page content.\n"
+
+    def get_many_markdown(self, urls):
+        return {url: self.get_markdown(url) for url in urls}
+
+
+class QueryCounter(object):
+    def __init__(self, engine):
+        self.count = 0
+        self._lock = threading.Lock()
+        event.listen(engine, "before_cursor_execute", self._count)
+
+    def _count(self, *args, **kwargs):
+        with self._lock:
+            self.count += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tasks", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    parser.add_argument("--tool-latency", type=float, default=0.02)
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--debounce", type=float, default=0.05,
+                        help="seconds an AI waits for more messages")
+    parser.add_argument("--ooda-mode", choices=["default", "single", "two"],
+                        default="default",
+                        help="force single call or two call OODA loops")
+    parser.add_argument("--verbose", action="store_true",
+                        help="show the prints of the AI handlers")
+    args = parser.parse_args()
+
+    if args.ooda_mode != "default":
+        for ooda_class in (AgentOODA, ManagerOODA, ClientOODA):
+            ooda_class.single_call = args.ooda_mode == "single"
+
+    app.config["AI_WAKEUP_DEBOUNCE"] = args.debounce
+    chat_completion = FakeChatCompletion(args.llm_latency)
+    # the fake replaces the network transport, not the client's scheduling
+    get_llm_client().transport = chat_completion.acreate
+    searcher = tools.get_searcher()
+    searcher.provider.latency = args.tool_latency
+    searcher.cache.clear()
+    tools.fetcher = FakeFetcher(args.tool_latency)
+
+    with app.app_context():
+        db.create_all()
+        create_user("alice", "alice@example.com", "alicepassword")
+        create_user("managerai", "managerai@example.com", "aipassword")
+        for username in app.config["AI_AGENT_USERNAMES"]:
+            create_user(username, f"{username}@example.com", "aipassword")
+        client_id = User.query.filter_by(username="alice").one().id
+        manager_id = User.query.filter_by(username="managerai").one().id
+        queries = QueryCounter(db.engine)
+
+    pool = WorkerPool(
+        app, claim=claim_next_job, run=run_job, worker_count=args.workers,
+        poll_interval=0.05,
+    ).start()
+    pub.subscribe(pool.notify, "tasks")
+
+    started_at = {}
+    finished_at = {}
+    quiet = open(os.devnull, "w")
+    if not args.verbose:
+        # the handlers print every OODA loop, from all worker threads
+        sys.stdout = quiet
+    start = time.perf_counter()
+    with app.app_context():
+        for i in range(args.tasks):
+            task = Task(title=f"Benchmark topic {i}", client_id=client_id,
+                        worker_id=manager_id)
+            db.session.add(task)
+            db.session.commit()
+            started_at[task.id] = time.perf_counter()
+            task.add_message(client_id, "Please research this topic.")
+
+    while len(finished_at) < args.tasks:
+        if time.perf_counter() - start > args.timeout:
+            break
+        with app.app_context():
+            done = db.session.execute(
+                db.select(TaskDiscussion.task_id).where(
+                    TaskDiscussion.task_id.in_(started_at),
+                    TaskDiscussion.user_id == manager_id,
+                    TaskDiscussion.message.startswith(FINAL_ANSWER),
+                )
+            ).scalars()
+            for task_id in done:
+                finished_at.setdefault(task_id, time.perf_counter())
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    pool.stop()
+    sys.stdout = sys.__stdout__
+    quiet.close()
+
+    with app.app_context():
+        failed = Job.query.filter_by(status="failed").count()
+        superseded = Job.query.filter_by(status="superseded").count()
+        skipped = Span.query.filter_by(name="ooda.skipped").count()
+    latencies = sorted(finished_at[t] - started_at[t] for t in finished_at)
+    print(f"tasks:        {len(finished_at)}/{args.tasks} finished, "
+          f"{failed} failed jobs")
+    print(f"wall time:    {elapsed:.2f} s")
+    print(f"throughput:   {len(finished_at) / elapsed:.2f} tasks/s")
+    if latencies:
+        p95 = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]
+        print(f"latency:      p50 {statistics.median(latencies):.2f} s, "
+              f"p95 {p95:.2f} s, max {latencies[-1]:.2f} s")
+    print(f"chat calls:   {chat_completion.calls}")
+    print(f"wake-ups:     {superseded} superseded jobs, {skipped} skipped loops")
+    print(f"search calls: {searcher.provider.calls}")
+    print(f"db queries:   {queries.count} "
+          f"({queries.count / max(1, len(finished_at)):.1f} per task)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Regression benchmark: building an observation must cost a constant number of
+queries, no matter how long the task discussion is, both for a task seen for
+the first time and for the next loop on it, which reuses the memoized history.
+
+Run from the repository root with
+
+    python -m benchmarks.observation_queries
+"""
+import time
+
+import config
+
+config.DevelopmentConfig.SQLALCHEMY_DATABASE_URI = "sqlite://"
+
+from sqlalchemy import event  # noqa: E402
+
+from app import Task, TaskDiscussion, User, app, build_observation, db  # noqa: E402
+from setup import create_user  # noqa: E402
+
+DISCUSSION_LENGTHS = [1, 10, 50, 200]
+
+
+class QueryCounter(object):
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _count(self, *args, **kwargs):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._count)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, "before_cursor_execute", self._count)
+
+
+def seed_task(length, client_id, worker_id, other_id):
+    task = Task(title=f"Task with {length} messages", client_id=client_id,
+                worker_id=worker_id)
+    db.session.add(task)
+    db.session.flush()
+    authors = [client_id, worker_id, other_id]
+    for i in range(length):
+        db.session.add(
+            TaskDiscussion(task_id=task.id, user_id=authors[i % 3],
+                           message=f"message {i}")
+        )
+    db.session.commit()
+    return task.id
+
+
+def main():
+    # keep every message verbatim, summarizing would call the model
+    app.config["OBSERVATION_TOKEN_BUDGET"] = 10**9
+    with app.app_context():
+        db.create_all()
+        create_user("alice", "alice@example.com", "alicepassword")
+        create_user("managerai", "managerai@example.com", "aipassword")
+        create_user("agentai", "agentai@example.com", "aipassword")
+        user_ids = [
+            User.query.filter_by(username=username).one().id
+            for username in ("alice", "managerai", "agentai")
+        ]
+
+        counts = {}
+        task_ids = {}
+        for length in DISCUSSION_LENGTHS:
+            task_id = task_ids[length] = seed_task(length, *user_ids)
+            # start from an empty identity map, like a fresh worker job
+            db.session.expunge_all()
+            with QueryCounter(db.engine) as counter:
+                start = time.perf_counter()
+                observation = build_observation(task_id)
+                elapsed = time.perf_counter() - start
+            assert observation.count("\n") == length + 1
+            counts[length] = counter.count
+            print(f"{length:>4} messages: {counter.count} queries, "
+                  f"{elapsed * 1000:.2f} ms")
+
+        assert len(set(counts.values())) == 1, (
+            f"query count grows with discussion length: {counts}"
+        )
+
+        # the next loop only loads and renders the new message
+        counts = {}
+        for length, task_id in task_ids.items():
+            db.session.add(
+                TaskDiscussion(task_id=task_id, user_id=user_ids[0],
+                               message="one more message")
+            )
+            db.session.commit()
+            db.session.expunge_all()
+            with QueryCounter(db.engine) as counter:
+                start = time.perf_counter()
+                observation = build_observation(task_id)
+                elapsed = time.perf_counter() - start
+            assert observation.count("\n") == length + 2
+            assert observation.endswith("one more message\n")
+            counts[length] = counter.count
+            print(f"{length:>4} messages, next loop: {counter.count} queries, "
+                  f"{elapsed * 1000:.2f} ms")
+
+        assert len(set(counts.values())) == 1, (
+            f"query count grows with discussion length: {counts}"
+        )
+        print("OK: query count is constant")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Regression benchmark: importing the app must stay fast and must not load the
+OpenAI, HTTP, HTML conversion or search client libraries, which are only
+needed once an AI calls the model or a tool.
+
+Every run imports the app in a fresh interpreter against an in-memory
+database. Run from the repository root with
+
+    python -m benchmarks.startup_time
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+basedir = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+
+# imported lazily by the clients and tools that use them
+DEFERRED_MODULES = ["openai", "httpx", "requests", "html2text", "serpapi"]
+
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.app.test_client().get("/login")
+served = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - start) * 1000,
+    "first_request_ms": (served - imported) * 1000,
+    "loaded": [m for m in %r if m in sys.modules],
+}))
+""" % (DEFERRED_MODULES,)
+
+
+def probe(env):
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE], cwd=basedir, env=env, check=True,
+        capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, default=1000,
+                        help="maximum median import time")
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp()
+    env = dict(
+        os.environ,
+        DATABASE_URL="sqlite://",
+        LLM_CACHE_PATH=os.path.join(scratch, "llm_cache.db"),
+        FETCH_CACHE_DIR=os.path.join(scratch, "fetch_cache"),
+    )
+    # the first run may compile bytecode, it is not counted
+    probe(env)
+    results = [probe(env) for _ in range(args.runs)]
+    import_ms = statistics.median(r["import_ms"] for r in results)
+    request_ms = statistics.median(r["first_request_ms"] for r in results)
+    print(f"import app:    {import_ms:.0f} ms (median of {args.runs})")
+    print(f"first request: {request_ms:.0f} ms")
+
+    loaded = sorted({m for r in results for m in r["loaded"]})
+    assert not loaded, f"importing the app loaded {loaded}"
+    assert not os.listdir(scratch), (
+        f"importing the app created {os.listdir(scratch)}"
+    )
+    assert import_ms <= args.budget_ms, (
+        f"import took {import_ms:.0f} ms, budget {args.budget_ms:.0f} ms"
+    )
+    print("OK: startup within budget, no client libraries loaded")
+
+
+if __name__ == "__main__":
+    main()
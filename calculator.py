@@ -0,0 +1,506 @@
+import ast
+import math
+import operator
+import re
+import time
+
+MAX_EXPRESSION_LENGTH = 2000
+MAX_ITEMS = 10000
+MAX_TOTAL_ITEMS = 100000
+MAX_INT_BITS = 4096
+MAX_EXPONENT = 10000
+# Nesting of the syntax tree, a chain of a+b+... or ---1 nests one per operator
+MAX_DEPTH = 100
+
+
+class CalculationError(ValueError):
+    """The expression is invalid, unsupported or too expensive"""
+
+
+def check_depth(tree):
+    """Refuse trees nested deeper than MAX_DEPTH, before visiting them
+    recursively. Walks with a stack of its own, so it cannot overflow."""
+    stack = [(tree, 1)]
+    while stack:
+        node, depth = stack.pop()
+        if depth > MAX_DEPTH:
+            raise CalculationError("Expression is too complex")
+        stack.extend((child, depth + 1) for child in ast.iter_child_nodes(node))
+
+
+# Base dimensions of a Quantity, in this order
+DIMENSIONS = ("m", "kg", "s", "A", "K", "mol", "B")
+
+
+class Quantity(object):
+    """A number with physical units, stored in base units.
+
+    `dims` holds the exponent of each base dimension, e.g. (1, 0, -1, ...)
+    for a speed. Results without dimensions collapse back to plain numbers.
+    """
+
+    def __init__(self, value, dims):
+        self.value = value
+        self.dims = tuple(dims)
+
+    @staticmethod
+    def make(value, dims):
+        if not any(dims):
+            return value
+        return Quantity(value, dims)
+
+    def _coerce(self, other):
+        if isinstance(other, Quantity):
+            return other
+        return Quantity(other, (0,) * len(DIMENSIONS))
+
+    def _same_dims(self, other, op):
+        other = self._coerce(other)
+        if self.dims != other.dims:
+            raise CalculationError(
+                f"Cannot {op} {format_dims(self.dims)} and {format_dims(other.dims)}"
+            )
+        return other
+
+    def __add__(self, other):
+        other = self._same_dims(other, "add")
+        return Quantity.make(self.value + other.value, self.dims)
+
+    def __radd__(self, other):
+        return self._coerce(other) + self
+
+    def __sub__(self, other):
+        other = self._same_dims(other, "subtract")
+        return Quantity.make(self.value - other.value, self.dims)
+
+    def __rsub__(self, other):
+        return self._coerce(other) - self
+
+    def __mul__(self, other):
+        other = self._coerce(other)
+        dims = [a + b for a, b in zip(self.dims, other.dims)]
+        return Quantity.make(self.value * other.value, dims)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        other = self._coerce(other)
+        dims = [a - b for a, b in zip(self.dims, other.dims)]
+        return Quantity.make(self.value / other.value, dims)
+
+    def __rtruediv__(self, other):
+        return self._coerce(other) / self
+
+    def __pow__(self, exponent):
+        if isinstance(exponent, Quantity):
+            raise CalculationError("Exponents must be plain numbers")
+        return Quantity.make(
+            self.value**exponent, [d * exponent for d in self.dims]
+        )
+
+    def __neg__(self):
+        return Quantity(-self.value, self.dims)
+
+    def __pos__(self):
+        return self
+
+    def __abs__(self):
+        return Quantity(abs(self.value), self.dims)
+
+    def __lt__(self, other):
+        return self.value < self._same_dims(other, "compare").value
+
+    def __repr__(self):
+        return f"{format_number(self.value)} {format_dims(self.dims)}"
+
+
+def format_dims(dims):
+    parts = []
+    for name, exponent in zip(DIMENSIONS, dims):
+        if exponent == 1:
+            parts.append(name)
+        elif exponent:
+            parts.append(f"{name}^{format_number(exponent)}")
+    return "*".join(parts) or "1"
+
+
+def _unit(value, **exponents):
+    return Quantity(value, [exponents.get(name, 0) for name in DIMENSIONS])
+
+
+UNITS = {
+    # length
+    "m": _unit(1, m=1),
+    "km": _unit(1000, m=1),
+    "cm": _unit(0.01, m=1),
+    "mm": _unit(0.001, m=1),
+    "um": _unit(1e-6, m=1),
+    "nm": _unit(1e-9, m=1),
+    "inch": _unit(0.0254, m=1),
+    "ft": _unit(0.3048, m=1),
+    "yd": _unit(0.9144, m=1),
+    "mi": _unit(1609.344, m=1),
+    "nmi": _unit(1852, m=1),
+    # area and volume
+    "ha": _unit(10000, m=2),
+    "acre": _unit(4046.8564224, m=2),
+    "L": _unit(0.001, m=3),
+    "mL": _unit(1e-6, m=3),
+    "gal": _unit(0.003785411784, m=3),
+    # mass
+    "kg": _unit(1, kg=1),
+    "g": _unit(0.001, kg=1),
+    "mg": _unit(1e-6, kg=1),
+    "t": _unit(1000, kg=1),
+    "lb": _unit(0.45359237, kg=1),
+    "oz": _unit(0.028349523125, kg=1),
+    # time
+    "s": _unit(1, s=1),
+    "ms": _unit(0.001, s=1),
+    "us": _unit(1e-6, s=1),
+    "ns": _unit(1e-9, s=1),
+    "minute": _unit(60, s=1),
+    "h": _unit(3600, s=1),
+    "day": _unit(86400, s=1),
+    "week": _unit(604800, s=1),
+    "year": _unit(31557600, s=1),
+    # electricity, temperature, amount
+    "A": _unit(1, A=1),
+    "K": _unit(1, K=1),
+    "mol": _unit(1, mol=1),
+    # data
+    "B": _unit(1, B=1),
+    "bit": _unit(0.125, B=1),
+    "KB": _unit(1e3, B=1),
+    "MB": _unit(1e6, B=1),
+    "GB": _unit(1e9, B=1),
+    "TB": _unit(1e12, B=1),
+    "KiB": _unit(2**10, B=1),
+    "MiB": _unit(2**20, B=1),
+    "GiB": _unit(2**30, B=1),
+    "TiB": _unit(2**40, B=1),
+    # derived
+    "Hz": _unit(1, s=-1),
+    "N": _unit(1, kg=1, m=1, s=-2),
+    "Pa": _unit(1, kg=1, m=-1, s=-2),
+    "kPa": _unit(1000, kg=1, m=-1, s=-2),
+    "bar": _unit(100000, kg=1, m=-1, s=-2),
+    "atm": _unit(101325, kg=1, m=-1, s=-2),
+    "J": _unit(1, kg=1, m=2, s=-2),
+    "kJ": _unit(1000, kg=1, m=2, s=-2),
+    "cal": _unit(4.184, kg=1, m=2, s=-2),
+    "kcal": _unit(4184, kg=1, m=2, s=-2),
+    "W": _unit(1, kg=1, m=2, s=-3),
+    "kW": _unit(1000, kg=1, m=2, s=-3),
+    "MW": _unit(1e6, kg=1, m=2, s=-3),
+    "Wh": _unit(3600, kg=1, m=2, s=-2),
+    "kWh": _unit(3.6e6, kg=1, m=2, s=-2),
+    "V": _unit(1, kg=1, m=2, s=-3, A=-1),
+    "mph": _unit(0.44704, m=1, s=-1),
+    "kph": _unit(1000 / 3600, m=1, s=-1),
+}
+
+CONSTANTS = {"pi": math.pi, "e": math.e, "tau": math.tau, "inf": math.inf}
+
+
+def _mean(values):
+    values = _as_list(values)
+    if not values:
+        raise CalculationError("mean() of an empty list")
+    return _reduce(operator.add, values) / len(values)
+
+
+def _reduce(op, values):
+    values = _as_list(values)
+    if not values:
+        return 0
+    result = values[0]
+    for value in values[1:]:
+        # checked at every step, a product can outgrow the limit long
+        # before the end of the list
+        result = check_size(op(result, value))
+    return result
+
+
+def check_size(value):
+    """Refuse integers (also as the value of a Quantity) above MAX_INT_BITS"""
+    number = value.value if isinstance(value, Quantity) else value
+    if isinstance(number, int) and number.bit_length() > MAX_INT_BITS:
+        raise CalculationError("Result is too large")
+    return value
+
+
+def _as_list(values):
+    if not isinstance(values, list):
+        raise CalculationError("Expected a list of numbers")
+    return values
+
+
+def _range(*args):
+    return list(range(*(int(arg) for arg in args)))
+
+
+def _sqrt(value):
+    if isinstance(value, Quantity):
+        return value**0.5
+    return math.sqrt(value)
+
+
+# Functions applied to each item of a list
+ELEMENTWISE = {
+    "sqrt": _sqrt,
+    "exp": math.exp,
+    "log": math.log,
+    "log10": math.log10,
+    "log2": math.log2,
+    "sin": math.sin,
+    "cos": math.cos,
+    "tan": math.tan,
+    "asin": math.asin,
+    "acos": math.acos,
+    "atan": math.atan,
+    "floor": math.floor,
+    "ceil": math.ceil,
+    "abs": abs,
+    "round": round,
+}
+
+# Functions of whole lists
+AGGREGATES = {
+    "sum": lambda values: _reduce(operator.add, values),
+    "prod": lambda values: _reduce(operator.mul, values),
+    "mean": _mean,
+    "min": lambda values: min(_as_list(values)),
+    "max": lambda values: max(_as_list(values)),
+    "len": lambda values: len(_as_list(values)),
+    "range": _range,
+}
+
+BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+
+UNARY_OPERATORS = {ast.UAdd: operator.pos, ast.USub: operator.neg}
+
+# "5 km" -> "(5*km)", a number directly followed by a name that is not a
+# function, binding tighter than the operators around it
+IMPLICIT_MULTIPLICATION = re.compile(
+    r"(?<![\w.])(\d+(?:\.\d*)?(?:[eE][+-]?\d+)?|\.\d+(?:[eE][+-]?\d+)?)"
+    r"(?![eE][+-]?\d)\s*([A-Za-z_]\w*)\b(?!\s*\()"
+)
+# "<expression> to <unit>" converts the result
+CONVERSION = re.compile(r"^(.*\S)\s+(?:to|in)\s+([A-Za-z_][\w*/^ ]*)$")
+
+
+class Evaluator(object):
+    """Walks a whitelisted subset of the Python AST.
+
+    Only numbers, lists, arithmetic, the names in UNITS and CONSTANTS and the
+    functions in ELEMENTWISE and AGGREGATES are allowed. The walk stops at a
+    deadline, and operations that could take unbounded CPU or memory (huge
+    powers, integers or lists) are refused up front.
+    """
+
+    def __init__(self, time_limit=0.1):
+        self.time_limit = time_limit
+        self.deadline = None
+        self.items = 0
+
+    def evaluate(self, expression):
+        if len(expression) > MAX_EXPRESSION_LENGTH:
+            raise CalculationError("Expression is too long")
+        expression = expression.strip().replace("^", "**")
+        target = None
+        match = CONVERSION.match(expression)
+        if match is not None:
+            expression, target = match.groups()
+        self.deadline = time.monotonic() + self.time_limit
+        value = self._evaluate_source(expression)
+        if target is not None:
+            return convert(value, self._evaluate_source(target), target.strip())
+        return value
+
+    def _evaluate_source(self, source):
+        source = IMPLICIT_MULTIPLICATION.sub(r"(\1*\2)", source)
+        try:
+            tree = ast.parse(source, mode="eval")
+        except SyntaxError as e:
+            raise CalculationError(f"Invalid expression: {e.msg}") from None
+        except (RecursionError, MemoryError):
+            raise CalculationError("Expression is too complex") from None
+        check_depth(tree.body)
+        try:
+            return self.visit(tree.body)
+        except (ArithmeticError, TypeError, ValueError) as e:
+            if isinstance(e, CalculationError):
+                raise
+            raise CalculationError(f"{type(e).__name__}: {e}") from None
+
+    def check_time(self):
+        if time.monotonic() > self.deadline:
+            raise CalculationError("Time limit exceeded")
+
+    def count_items(self, values):
+        """Refuse lists longer than MAX_ITEMS, or building more than
+        MAX_TOTAL_ITEMS list items in total"""
+        self.items += len(values)
+        if len(values) > MAX_ITEMS:
+            raise CalculationError(f"Lists are limited to {MAX_ITEMS} items")
+        if self.items > MAX_TOTAL_ITEMS:
+            raise CalculationError("Too many list operations")
+        return values
+
+    def elementwise(self, f, *args):
+        """Apply f item by item, broadcasting scalars over lists like NumPy"""
+        lists = [arg for arg in args if isinstance(arg, list)]
+        if not lists:
+            return f(*args)
+        length = len(lists[0])
+        if any(len(items) != length for items in lists):
+            raise CalculationError("Lists of different lengths")
+        self.check_time()
+        return self.count_items(
+            [
+                self.elementwise(
+                    f, *[arg[i] if isinstance(arg, list) else arg for arg in args]
+                )
+                for i in range(length)
+            ]
+        )
+
+    def visit(self, node):
+        self.check_time()
+        method = getattr(self, f"visit_{type(node).__name__}", None)
+        if method is None:
+            raise CalculationError(f"Unsupported syntax: {type(node).__name__}")
+        return method(node)
+
+    def visit_Constant(self, node):
+        if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+            raise CalculationError(f"Unsupported constant: {node.value!r}")
+        return node.value
+
+    def visit_Name(self, node):
+        if node.id in CONSTANTS:
+            return CONSTANTS[node.id]
+        if node.id in UNITS:
+            return UNITS[node.id]
+        raise CalculationError(f"Unknown name: {node.id}")
+
+    def visit_List(self, node):
+        return self.count_items([self.visit(item) for item in node.elts])
+
+    visit_Tuple = visit_List
+
+    def visit_UnaryOp(self, node):
+        op = UNARY_OPERATORS.get(type(node.op))
+        if op is None:
+            raise CalculationError(f"Unsupported operator: {type(node.op).__name__}")
+        return self.elementwise(op, self.visit(node.operand))
+
+    def visit_BinOp(self, node):
+        op = BINARY_OPERATORS.get(type(node.op))
+        if op is None:
+            raise CalculationError(f"Unsupported operator: {type(node.op).__name__}")
+        left, right = self.visit(node.left), self.visit(node.right)
+        if op is operator.pow:
+            return self.elementwise(self._power, left, right)
+        return self.elementwise(lambda a, b: self._checked(op(a, b)), left, right)
+
+    def visit_Call(self, node):
+        if not isinstance(node.func, ast.Name) or node.keywords:
+            raise CalculationError("Only simple function calls are supported")
+        args = [self.visit(arg) for arg in node.args]
+        name = node.func.id
+        if name == "range":
+            if len(args) > 3 or len(range(*(int(arg) for arg in args))) > MAX_ITEMS:
+                raise CalculationError(f"Lists are limited to {MAX_ITEMS} items")
+        if name in ELEMENTWISE:
+            return self.elementwise(
+                lambda *a: self._checked(ELEMENTWISE[name](*a)), *args
+            )
+        if name in AGGREGATES:
+            result = AGGREGATES[name](*args)
+            if isinstance(result, list):
+                return self.count_items(result)
+            return self._checked(result)
+        raise CalculationError(f"Unknown function: {name}")
+
+    def _power(self, base, exponent):
+        if isinstance(exponent, (int, float)) and abs(exponent) > MAX_EXPONENT:
+            raise CalculationError("Exponent is too large")
+        # a power of a quantity raises its value, e.g. (km**9999)**9999
+        number = base.value if isinstance(base, Quantity) else base
+        if isinstance(number, int) and isinstance(exponent, int) and exponent > 0:
+            # estimate the size before computing it
+            if number not in (0, 1, -1) and (
+                abs(number).bit_length() * exponent > MAX_INT_BITS
+            ):
+                raise CalculationError("Result is too large")
+        return self._checked(base**exponent)
+
+    def _checked(self, value):
+        check_size(value)
+        if isinstance(value, complex):
+            raise CalculationError("Complex results are not supported")
+        return value
+
+
+def convert(value, unit, name):
+    """Express a quantity (or a list of them) in the given unit"""
+    if isinstance(value, list):
+        return [convert(item, unit, name) for item in value]
+    if not isinstance(unit, Quantity) or not isinstance(value, Quantity):
+        raise CalculationError(f"Can only convert quantities with units to {name}")
+    if value.dims != unit.dims:
+        raise CalculationError(f"Cannot convert {format_dims(value.dims)} to {name}")
+    return Converted(value.value / unit.value, name)
+
+
+class Converted(object):
+    """A quantity expressed in a chosen unit, for display"""
+
+    def __init__(self, value, name):
+        self.value = value
+        self.name = name
+
+    def __repr__(self):
+        return f"{format_number(self.value)} {self.name}"
+
+
+def format_number(value):
+    if isinstance(value, float):
+        if value.is_integer() and abs(value) < 1e15:
+            return str(int(value))
+        return format(value, ".12g")
+    return str(value)
+
+
+def format_result(value):
+    if isinstance(value, list):
+        return "[" + ", ".join(format_result(item) for item in value) + "]"
+    if isinstance(value, (int, float)):
+        return format_number(value)
+    return repr(value)
+
+
+def calculate(expression, time_limit=0.1):
+    """Evaluate an expression and return the result as text.
+
+    Examples: "2 * (3 + 4)", "sqrt([1, 4, 9]) * 2", "mean([3, 5, 10])",
+    "5 km + 300 m to mi", "1.5 GB / (20 MB / s) to minute".
+    Raises CalculationError for invalid or too expensive expressions.
+    """
+    value = Evaluator(time_limit=time_limit).evaluate(expression)
+    try:
+        return format_result(value)
+    except (OverflowError, ValueError) as e:
+        if isinstance(e, CalculationError):
+            raise
+        raise CalculationError(f"Cannot format the result: {e}") from None
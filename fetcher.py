@@ -0,0 +1,186 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+def html_to_markdown(html):
+    import html2text
+
+    # HTML2Text keeps parser state per document, so it is not shared
+    text_maker = html2text.HTML2Text()
+    text_maker.ignore_links = False
+    return text_maker.handle(html)
+
+
+class DiskCache(object):
+    """Stores fetched pages as JSON files named by the hash of their URL.
+
+    Entries older than `max_age` seconds are ignored, and every
+    `prune_every` writes they are deleted, then the oldest entries until the
+    cache holds at most `max_bytes`.
+    """
+
+    def __init__(self, directory, max_bytes=None, max_age=None, prune_every=100):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.prune_every = prune_every
+        self._writes = 0
+
+    def _path(self, url):
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, url):
+        path = self._path(url)
+        try:
+            if self.max_age is not None and (
+                time.time() - os.path.getmtime(path) > self.max_age
+            ):
+                return None
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def set(self, url, entry):
+        os.makedirs(self.directory, exist_ok=True)
+        # write to a temporary file first so readers never see partial files
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, self._path(url))
+        self._writes += 1
+        if self._writes % self.prune_every == 0:
+            self.prune()
+
+    def prune(self):
+        """Delete expired entries, then the oldest ones above max_bytes"""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".json"):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                # deleted meanwhile, e.g. by another process pruning
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort(reverse=True)
+        now = time.time()
+        total = 0
+        for modified_at, size, path in entries:
+            total += size
+            if (self.max_age is not None and now - modified_at > self.max_age) or (
+                self.max_bytes is not None and total > self.max_bytes
+            ):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+class Fetcher(object):
+    """Downloads pages as markdown over a pooled HTTP session.
+
+    - requests time out after `timeout` seconds
+    - bodies are streamed and cut off after `max_bytes`
+    - with a `cache`, pages younger than `fresh_for` seconds are served
+      without a request, older ones are revalidated with a conditional GET
+      (If-None-Match / If-Modified-Since) and a 304 reuses the cached markdown
+    - responses with `Cache-Control: no-store` are not cached
+    """
+
+    def __init__(
+        self,
+        timeout=10,
+        max_bytes=2_000_000,
+        cache=None,
+        fresh_for=3600,
+        max_workers=8,
+    ):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.cache = cache
+        self.fresh_for = fresh_for
+        self.max_workers = max_workers
+        # imported here so that importing the module stays cheap
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _download(self, url, headers):
+        with self.session.get(
+            url, headers=headers, timeout=self.timeout, stream=True
+        ) as response:
+            if response.status_code == 304:
+                return response, None
+            response.raise_for_status()
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(chunk_size=65536):
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= self.max_bytes:
+                    break
+            body = b"".join(chunks)[: self.max_bytes]
+            return response, body.decode(response.encoding or "utf-8", "replace")
+
+    def get_markdown(self, url):
+        cached = self.cache.get(url) if self.cache is not None else None
+        if cached is not None:
+            if time.time() - cached["fetched_at"] < self.fresh_for:
+                return cached["markdown"]
+
+        headers = {}
+        if cached is not None:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+
+        response, html = self._download(url, headers)
+        entry = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "fetched_at": time.time(),
+        }
+        if html is None:
+            # 304 Not Modified, the validators may be omitted from the response
+            entry["etag"] = entry["etag"] or cached.get("etag")
+            entry["last_modified"] = entry["last_modified"] or cached.get(
+                "last_modified"
+            )
+            entry["markdown"] = cached["markdown"]
+        else:
+            entry["markdown"] = html_to_markdown(html)
+
+        cache_control = response.headers.get("Cache-Control", "").lower()
+        if self.cache is not None and "no-store" not in cache_control:
+            self.cache.set(url, entry)
+        return entry["markdown"]
+
+    def get_many_markdown(self, urls):
+        """Fetch and convert many URLs concurrently.
+
+        Returns a dict from URL to markdown, or to the exception raised while
+        fetching that URL, so one bad URL does not fail the batch.
+        """
+
+        def fetch(url):
+            try:
+                return self.get_markdown(url)
+            except Exception as e:
+                return e
+
+        unique_urls = list(dict.fromkeys(urls))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return dict(zip(unique_urls, executor.map(fetch, unique_urls)))
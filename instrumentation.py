@@ -0,0 +1,89 @@
+import contextlib
+import contextvars
+import functools
+import threading
+import time
+from datetime import datetime
+
+# The task the current thread (or job) is working on, attached to every span
+current_task_id = contextvars.ContextVar("current_task_id", default=None)
+
+# USD per 1K (prompt, completion) tokens
+PRICES_PER_1K_TOKENS = {
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-4": (0.03, 0.06),
+}
+
+_finished = []
+_lock = threading.Lock()
+
+
+def _new_record(name):
+    return {
+        "name": name,
+        "task_id": current_task_id.get(),
+        "started_at": datetime.utcnow(),
+        "duration_ms": 0.0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "cost": 0.0,
+        "ok": True,
+    }
+
+
+def _finish(record):
+    with _lock:
+        _finished.append(record)
+
+
+@contextlib.contextmanager
+def span(name):
+    """Time the enclosed block, yielding the span record to annotate"""
+    record = _new_record(name)
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception:
+        record["ok"] = False
+        raise
+    finally:
+        record["duration_ms"] = (time.perf_counter() - start) * 1000
+        _finish(record)
+
+
+def timed(name):
+    """Decorator form of span"""
+
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def record_span(name, duration_ms):
+    """Record a span that was timed elsewhere, e.g. from SQLAlchemy events"""
+    record = _new_record(name)
+    record["duration_ms"] = duration_ms
+    _finish(record)
+
+
+def record_usage(record, model, prompt_tokens, completion_tokens):
+    prompt_price, completion_price = PRICES_PER_1K_TOKENS.get(model, (0.0, 0.0))
+    record["prompt_tokens"] += prompt_tokens
+    record["completion_tokens"] += completion_tokens
+    record["cost"] += (
+        prompt_tokens * prompt_price + completion_tokens * completion_price
+    ) / 1000
+
+
+def drain():
+    """Take all finished span records, to be persisted by the caller"""
+    global _finished
+    with _lock:
+        records, _finished = _finished, []
+    return records
@@ -0,0 +1,75 @@
+from sqlalchemy import inspect, literal
+
+from app import Task, app, backfill_search_index, backfill_task_rollups, db
+
+
+def column_ddl(column, dialect):
+    """ALTER TABLE ... ADD COLUMN clause for a model column.
+
+    NOT NULL is only kept when the column has a scalar default to fill the
+    existing rows with.
+    """
+    ddl = f"{column.name} {column.type.compile(dialect=dialect)}"
+    default = column.default
+    if default is not None and default.is_scalar:
+        value = literal(default.arg, type_=column.type).compile(
+            dialect=dialect, compile_kwargs={"literal_binds": True}
+        )
+        ddl += f" DEFAULT {value}"
+        if not column.nullable:
+            ddl += " NOT NULL"
+    return ddl
+
+
+def upgrade_database():
+    """Bring an existing database up to date with the models.
+
+    Creates missing tables, then adds missing columns and indexes to existing
+    tables, which db.create_all() alone does not do. Nothing is dropped but
+    indexes that were replaced. Returns the added columns as (table, column) pairs.
+    """
+    added = []
+    tables = set(inspect(db.engine).get_table_names())
+    db.create_all()
+    inspector = inspect(db.engine)
+    dialect = db.engine.dialect
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            columns = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in columns:
+                    print(f"Adding column {table.name}.{column.name}")
+                    added.append((table.name, column.name))
+                    conn.exec_driver_sql(
+                        f"ALTER TABLE {table.name} "
+                        f"ADD COLUMN {column_ddl(column, dialect)}"
+                    )
+            indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    print(f"Creating index {index.name}")
+                    index.create(conn)
+        # replaced by ix_task_discussion_task_id_id
+        conn.exec_driver_sql(
+            "DROP INDEX IF EXISTS ix_task_discussion_task_id_timestamp"
+        )
+    if ("task", "message_count") in added:
+        print("Computing task rollups")
+        backfill_task_rollups()
+    if ("task", "joined_subtask_count") in added:
+        # subtasks that were all complete had their results joined already
+        db.session.execute(
+            db.update(Task)
+            .where(Task.open_subtask_count == 0)
+            .values(joined_subtask_count=Task.complete_subtask_count)
+        )
+        db.session.commit()
+    if tables and "search_entry" not in tables:
+        print("Building the search index")
+        backfill_search_index()
+    return added
+
+
+if __name__ == "__main__":
+    with app.app_context():
+        upgrade_database()
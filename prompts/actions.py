@@ -0,0 +1,107 @@
+import re
+from collections import namedtuple
+
+Action = namedtuple("Action", ["name", "argument"])
+
+QUOTES = "\"'`"
+
+
+def clean_argument(argument):
+    argument = argument.strip()
+    if len(argument) >= 2 and argument[0] == argument[-1] and argument[0] in QUOTES:
+        argument = argument[1:-1]
+    return argument
+
+
+class ActionParser(object):
+    """Parses ACTION_NAME(ARGUMENT) out of a model response.
+
+    Only the given action names are recognized, so prose around the action
+    is ignored, and the argument may contain balanced parentheses. Cheap
+    local repairs are applied before giving up: a lowercase name, a missing
+    closing parenthesis, or a line starting with `ACTION_NAME: argument`
+    without parentheses. Anything else is left to a re-prompt.
+    """
+
+    def __init__(self, names):
+        self.names = set(names)
+        # longest first so that CREATE_SUBTASKS wins over CREATE_SUBTASK
+        alternatives = "|".join(
+            re.escape(name) for name in sorted(self.names, key=len, reverse=True)
+        )
+        self.call = re.compile(rf"\b({alternatives})\s*\(", re.IGNORECASE)
+        # as written, a name mentioned in a sentence is not an action
+        self.bare = re.compile(
+            rf"^[ \t]*({alternatives})[ \t]*:[ \t]*(.*)$", re.MULTILINE
+        )
+
+    def _find_call(self, text):
+        """The first call's match and the index of its closing parenthesis,
+        None if it is not closed (yet)"""
+        match = self.call.search(text)
+        if match is None:
+            return None, None
+        depth = 1
+        for i in range(match.end(), len(text)):
+            if text[i] == "(":
+                depth += 1
+            elif text[i] == ")":
+                depth -= 1
+                if depth == 0:
+                    return match, i
+        return match, None
+
+    def complete(self, text):
+        """The text of the first complete ACTION_NAME(ARGUMENT), or None,
+        e.g. to stop a streamed response as soon as it holds an action"""
+        match, end = self._find_call(text)
+        if end is None:
+            return None
+        return text[match.start() : end + 1]
+
+    def parse(self, text):
+        """Return the first Action in text, or None if there is none"""
+        match, end = self._find_call(text)
+        if match is not None:
+            name = match.group(1).upper()
+            if end is not None:
+                return Action(name, clean_argument(text[match.end() : end]))
+            # never closed, the argument runs to the end of the line
+            argument = text[match.end() :].split("\n")[0]
+            return Action(name, clean_argument(argument))
+        match = self.bare.search(text)
+        if match is not None:
+            return Action(match.group(1), clean_argument(match.group(2)))
+        return None
+
+
+class ActionRegistry(object):
+    """Maps action names to handlers of an AI.
+
+    Handlers are registered with the decorator and called as
+    handler(ai, task, as_user, argument).
+    """
+
+    def __init__(self):
+        self.handlers = {}
+        self._parser = None
+
+    def register(self, name):
+        def decorator(handler):
+            self.handlers[name] = handler
+            self._parser = None
+            return handler
+
+        return decorator
+
+    @property
+    def parser(self):
+        if self._parser is None:
+            self._parser = ActionParser(self.handlers)
+        return self._parser
+
+    def parse(self, text):
+        return self.parser.parse(text)
+
+    def dispatch(self, ai, task, as_user, action):
+        return self.handlers[action.name](ai, task, as_user, action.argument)
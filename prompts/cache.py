@@ -0,0 +1,204 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheMiss(LookupError):
+    """Raised in replay mode when a response is not in the cache"""
+
+
+def cache_key(model, messages, **params):
+    """A content hash of everything that determines a chat completion"""
+    payload = json.dumps(
+        {"model": model, "messages": messages, "params": params},
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemoryCache(object):
+    """In-process LRU tier"""
+
+    def __init__(self, max_entries=1024, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, created_at = entry
+            if self.ttl is not None and time.time() - created_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteCache(object):
+    """Persistent tier, shared between processes through a SQLite file.
+
+    Hits only write when the entry's accessed_at is more than touch_interval
+    seconds old, so reads of a hot entry stay reads and the LRU order is kept
+    to within touch_interval.
+    """
+
+    def __init__(self, path, max_entries=100000, ttl=None, touch_interval=300):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.touch_interval = touch_interval
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS response (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )"""
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS response_accessed_at "
+                "ON response (accessed_at)"
+            )
+
+    def _connect(self):
+        # sqlite3 connections cannot be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self._connect()
+        row = conn.execute(
+            "SELECT value, created_at, accessed_at FROM response WHERE key = ?",
+            (key,),
+        ).fetchone()
+        if row is None:
+            return None
+        value, created_at, accessed_at = row
+        now = time.time()
+        if self.ttl is not None and now - created_at > self.ttl:
+            with conn:
+                conn.execute("DELETE FROM response WHERE key = ?", (key,))
+            return None
+        if now - accessed_at > self.touch_interval:
+            with conn:
+                conn.execute(
+                    "UPDATE response SET accessed_at = ? WHERE key = ?", (now, key)
+                )
+        return value
+
+    def set(self, key, value):
+        conn = self._connect()
+        now = time.time()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO response VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            if self.ttl is not None:
+                conn.execute(
+                    "DELETE FROM response WHERE created_at < ?", (now - self.ttl,)
+                )
+            # evict the least recently used entries beyond max_entries
+            conn.execute(
+                """DELETE FROM response WHERE key IN (
+                    SELECT key FROM response ORDER BY accessed_at DESC
+                    LIMIT -1 OFFSET ?
+                )""",
+                (self.max_entries,),
+            )
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM response")
+
+
+class ResponseCache(object):
+    """Looks responses up through a list of tiers, fastest first.
+
+    mode is one of:
+    - "on": serve hits from the cache and store every new response
+    - "off": always call the model
+    - "replay": only serve from the cache, raising CacheMiss otherwise. This
+      makes runs deterministic and lets the OODA classes run offline.
+    """
+
+    MODES = ("on", "off", "replay")
+
+    def __init__(self, tiers, mode="on"):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown cache mode {mode!r}, use one of {self.MODES}")
+        self.tiers = tiers
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        # tiers are shared by every worker thread
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<ResponseCache {self.mode} hits:{self.hits} misses:{self.misses}>"
+
+    def get(self, key):
+        for i, tier in enumerate(self.tiers):
+            value = tier.get(key)
+            if value is not None:
+                # promote to the faster tiers
+                for faster in self.tiers[:i]:
+                    faster.set(key, value)
+                with self._lock:
+                    self.hits += 1
+                return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, value):
+        for tier in self.tiers:
+            tier.set(key, value)
+
+    def get_or_create(self, key, create, accept=None):
+        """Return the cached response for key, calling create() on a miss.
+
+        When given, accept(response) tells usable responses apart. Others are
+        not stored, and count as a miss when cached, unless replaying.
+        """
+        if self.mode == "off":
+            return create()
+        value = self.get(key)
+        if value is not None and (
+            accept is None or self.mode == "replay" or accept(value)
+        ):
+            return value
+        if self.mode == "replay":
+            raise CacheMiss(f"No cached response for {key} in replay mode")
+        value = create()
+        if accept is None or accept(value):
+            self.set(key, value)
+        return value
+
+    def clear(self):
+        for tier in self.tiers:
+            tier.clear()
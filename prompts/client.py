@@ -0,0 +1,321 @@
+import asyncio
+import itertools
+import os
+import queue
+import random
+import threading
+import time
+
+from prompts.tokens import count_tokens
+
+# Request priorities, lower runs first
+INTERACTIVE = 0
+BACKGROUND = 10
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+RETRYABLE_ERRORS = {
+    "APIConnectionError",
+    "APIError",
+    "APITimeoutError",
+    "InternalServerError",
+    "RateLimitError",
+}
+
+
+def is_retryable(error):
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError)):
+        return True
+    status = getattr(error, "status_code", None) or getattr(error, "status", None)
+    if status in RETRYABLE_STATUS:
+        return True
+    return type(error).__name__ in RETRYABLE_ERRORS
+
+
+def retry_after(error):
+    """Seconds the server asked us to wait, if it did"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class OpenAITransport(object):
+    """Chat completions through the openai library's async client, sharing
+    one connection pool between all requests of the event loop.
+
+    Completions and stream chunks are returned as plain dicts. The library's
+    own retries are off, LLMClient retries with its rate limits in mind.
+    """
+
+    def __init__(self, api_key=None, base_url=None):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.client = None
+
+    async def __call__(self, model, messages, stream=False, **params):
+        if self.client is None:
+            # the openai library is slow to import, only pay for it on first use
+            import openai
+
+            self.client = openai.AsyncOpenAI(
+                api_key=self.api_key or os.getenv("OPENAI_API_KEY"),
+                base_url=self.base_url or os.getenv("OPENAI_BASE_URL"),
+                max_retries=0,
+            )
+        completion = await self.client.chat.completions.create(
+            model=model, messages=messages, stream=stream, **params
+        )
+        if stream:
+            return self._chunks(completion)
+        return completion.model_dump()
+
+    async def _chunks(self, stream):
+        try:
+            async for chunk in stream:
+                # the final chunk with the usage may have no choices
+                if chunk.choices:
+                    yield chunk.model_dump()
+        finally:
+            await stream.close()
+
+
+class TokenBucket(object):
+    """Allows `per_minute` units per minute, in bursts up to one minute's worth.
+
+    Runs on the client's event loop, so it needs no thread locking.
+    """
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = float(per_minute)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated_at
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, amount):
+        # a request larger than the bucket waits for a full bucket
+        amount = min(amount, self.capacity)
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def debit(self, amount):
+        """Charge usage only known after the fact, may go negative"""
+        self._refill()
+        self.tokens -= amount
+
+
+class LLMClient(object):
+    """Schedules chat completions on a private asyncio event loop.
+
+    Callers in any thread submit requests with a priority. A fixed number of
+    dispatchers (the global concurrency limit) take the most urgent request
+    first, wait for the request and token rate limits, and call the
+    transport with a timeout, retrying retryable errors with jittered
+    exponential backoff. `timeout` bounds each call and each read of a
+    stream, `wait_timeout` how long a caller waits for a result or the next
+    piece, queueing and retries included. The loop and its dispatchers start
+    on first use.
+    """
+
+    def __init__(
+        self,
+        transport=None,
+        max_concurrency=8,
+        requests_per_minute=3500,
+        tokens_per_minute=90000,
+        timeout=60,
+        wait_timeout=600,
+        max_retries=5,
+        backoff_base=0.5,
+        backoff_cap=30,
+    ):
+        self.transport = transport or OpenAITransport()
+        self.max_concurrency = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.timeout = timeout
+        self.wait_timeout = wait_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.loop = None
+        self._start_lock = threading.Lock()
+        self._sequence = itertools.count()
+
+    def _start(self):
+        with self._start_lock:
+            if self.loop is not None:
+                return
+            started = threading.Event()
+
+            def run():
+                self.loop = asyncio.new_event_loop()
+                asyncio.set_event_loop(self.loop)
+                self.pending = asyncio.PriorityQueue()
+                self.request_bucket = TokenBucket(self.requests_per_minute)
+                self.token_bucket = TokenBucket(self.tokens_per_minute)
+                for _ in range(self.max_concurrency):
+                    self.loop.create_task(self._dispatch())
+                started.set()
+                self.loop.run_forever()
+
+            threading.Thread(target=run, name="llm-client", daemon=True).start()
+            started.wait()
+
+    def _submit(self, request, priority):
+        if self.loop is None:
+            self._start()
+        item = (priority, next(self._sequence), request)
+        self.loop.call_soon_threadsafe(self.pending.put_nowait, item)
+
+    async def _dispatch(self):
+        while True:
+            _, _, request = await self.pending.get()
+            try:
+                await self._run(request)
+            except Exception as e:
+                request["on_error"](e)
+
+    async def _run(self, request):
+        model, messages = request["model"], request["messages"]
+        params = request["params"]
+        prompt_tokens = sum(count_tokens(message["content"]) for message in messages)
+        for attempt in range(self.max_retries + 1):
+            # the caller gave up waiting
+            if request["cancelled"].is_set():
+                return
+            await self.request_bucket.acquire(1)
+            await self.token_bucket.acquire(
+                prompt_tokens + params.get("max_tokens", 0)
+            )
+            try:
+                if request["stream"]:
+                    await self._stream(request)
+                else:
+                    completion = await asyncio.wait_for(
+                        self.transport(model, messages, **params), self.timeout
+                    )
+                    usage = completion.get("usage") or {}
+                    self.token_bucket.debit(usage.get("completion_tokens", 0))
+                    request["on_result"](completion)
+                return
+            except Exception as e:
+                # a stream that already produced output cannot be replayed
+                if (
+                    attempt == self.max_retries
+                    or not is_retryable(e)
+                    or request.get("started")
+                ):
+                    raise
+                delay = retry_after(e) or random.uniform(
+                    0, min(self.backoff_cap, self.backoff_base * 2**attempt)
+                )
+                print(f"LLM call failed with {e!r}, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def _stream(self, request):
+        completion = await asyncio.wait_for(
+            self.transport(
+                request["model"],
+                request["messages"],
+                stream=True,
+                **request["params"],
+            ),
+            self.timeout,
+        )
+        tokens = 0
+        chunks = completion.__aiter__()
+        try:
+            while not request["cancelled"].is_set():
+                # a stalled stream fails like a stalled call
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), self.timeout)
+                except StopAsyncIteration:
+                    break
+                piece = chunk["choices"][0]["delta"].get("content")
+                if piece:
+                    request["started"] = True
+                    tokens += count_tokens(piece)
+                    request["on_piece"](piece)
+        finally:
+            if hasattr(completion, "aclose"):
+                await completion.aclose()
+        self.token_bucket.debit(tokens)
+        request["on_done"]()
+
+    def create(self, model, messages, priority=BACKGROUND, **params):
+        """Blocking chat completion, returns the completion dict"""
+        done = threading.Event()
+        cancelled = threading.Event()
+        outcome = {}
+
+        def on_result(completion):
+            outcome["completion"] = completion
+            done.set()
+
+        def on_error(error):
+            outcome["error"] = error
+            done.set()
+
+        self._submit(
+            {
+                "model": model,
+                "messages": messages,
+                "params": params,
+                "stream": False,
+                "cancelled": cancelled,
+                "on_result": on_result,
+                "on_error": on_error,
+            },
+            priority,
+        )
+        if not done.wait(self.wait_timeout):
+            cancelled.set()
+            raise TimeoutError(f"No completion after {self.wait_timeout}s")
+        if "error" in outcome:
+            raise outcome["error"]
+        return outcome["completion"]
+
+    def stream(self, model, messages, priority=BACKGROUND, **params):
+        """Blocking generator of response pieces. Closing it early stops the
+        stream and frees the connection."""
+        pieces = queue.Queue()
+        cancelled = threading.Event()
+        end = object()
+        self._submit(
+            {
+                "model": model,
+                "messages": messages,
+                "params": params,
+                "stream": True,
+                "cancelled": cancelled,
+                "on_piece": pieces.put,
+                "on_done": lambda: pieces.put(end),
+                "on_error": pieces.put,
+            },
+            priority,
+        )
+        try:
+            while True:
+                try:
+                    piece = pieces.get(timeout=self.wait_timeout)
+                except queue.Empty:
+                    raise TimeoutError(f"No response piece after {self.wait_timeout}s")
+                if piece is end:
+                    return
+                if isinstance(piece, Exception):
+                    raise piece
+                yield piece
+        finally:
+            cancelled.set()
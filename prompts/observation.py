@@ -0,0 +1,67 @@
+from prompts.prompts import chat
+from prompts.tokens import TOKEN_PATTERN, count_tokens
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text after max_tokens tokens, noting how much was cut"""
+    used = 0
+    for match in TOKEN_PATTERN.finditer(text):
+        used += (len(match.group()) + 3) // 4
+        if used > max_tokens:
+            rest = count_tokens(text[match.start() :])
+            return f"{text[: match.start()]}... [truncated {rest} tokens]\n"
+    return text
+
+
+def split_tokens(text, max_tokens):
+    """Split text into consecutive parts of at most max_tokens tokens"""
+    parts = []
+    start = used = 0
+    for match in TOKEN_PATTERN.finditer(text):
+        tokens = (len(match.group()) + 3) // 4
+        if used and used + tokens > max_tokens:
+            parts.append(text[start : match.start()])
+            start, used = match.start(), 0
+        used += tokens
+    parts.append(text[start:])
+    return parts
+
+
+def split_window(lines, budget):
+    """Split lines into (older, recent) where recent is the longest tail of
+    lines that fits in budget tokens"""
+    used = 0
+    for i in range(len(lines) - 1, -1, -1):
+        used += count_tokens(lines[i])
+        if used > budget:
+            return lines[: i + 1], lines[i + 1 :]
+    return [], lines
+
+
+def summarize(previous_summary, lines, max_tokens):
+    """Fold lines into the running summary of a task discussion"""
+    prompt = f"""
+Below is a summary of the beginning of a task discussion, followed by the
+messages that came after it. Write an updated summary of the whole discussion
+in at most {max_tokens * 3 // 4} words. Keep facts, decisions, open questions,
+URLs and numbers that may be needed to complete the task.
+
+### SUMMARY SO FAR ###
+{previous_summary or "(none)"}
+
+### NEW MESSAGES ###
+{"".join(lines)}
+
+### UPDATED SUMMARY ###
+"""
+    return truncate_to_tokens(chat(prompt).strip(), max_tokens)
+
+
+SUMMARY_HEADING = "Summary of earlier messages:\n"
+
+
+def render_observation(header, summary, lines):
+    observation = header
+    if summary:
+        observation += f"{SUMMARY_HEADING}{summary}\n\n"
+    return observation + "".join(lines)
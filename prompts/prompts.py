@@ -1,54 +1,335 @@
+import contextvars
+import json
 import os
-import openai
+import threading
+
+from instrumentation import record_usage, span
+from prompts.client import BACKGROUND, INTERACTIVE, LLMClient
+from prompts.cache import (
+    CacheMiss,
+    MemoryCache,
+    ResponseCache,
+    SQLiteCache,
+    cache_key,
+)
+from prompts.tokens import count_tokens
+
+basedir = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
+
+# The attempt of the job the current thread works on. A retried job gets
+# responses of its own instead of replaying the ones its failed attempt got.
+current_attempt = contextvars.ContextVar("current_attempt", default=1)
+
+
+def build_response_cache():
+    """Configure the chat response cache from the environment"""
+    ttl = os.getenv("LLM_CACHE_TTL")
+    ttl = float(ttl) if ttl else None
+    tiers = [
+        MemoryCache(
+            max_entries=int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", 1024)), ttl=ttl
+        )
+    ]
+    # an empty LLM_CACHE_PATH keeps the cache in memory only
+    path = os.getenv("LLM_CACHE_PATH", os.path.join(basedir, "llm_cache.db"))
+    if path:
+        tiers.append(
+            SQLiteCache(
+                path,
+                max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", 100000)),
+                ttl=ttl,
+            )
+        )
+    return ResponseCache(tiers, mode=os.getenv("LLM_CACHE", "on"))
+
+
+def build_llm_client():
+    """Configure the LLM client from the environment"""
+    return LLMClient(
+        max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", 8)),
+        requests_per_minute=int(os.getenv("LLM_REQUESTS_PER_MINUTE", 3500)),
+        tokens_per_minute=int(os.getenv("LLM_TOKENS_PER_MINUTE", 90000)),
+        timeout=float(os.getenv("LLM_TIMEOUT", 60)),
+        wait_timeout=float(os.getenv("LLM_WAIT_TIMEOUT", 600)),
+        max_retries=int(os.getenv("LLM_MAX_RETRIES", 5)),
+    )
+
+
+# Created on first use, so that importing this module opens no files and
+# reads the environment only once it is fully loaded. Assign them to replace
+# the defaults, e.g. in benchmarks.
+response_cache = None
+llm_client = None
+_init_lock = threading.Lock()
+
+
+def get_response_cache():
+    global response_cache
+    with _init_lock:
+        if response_cache is None:
+            response_cache = build_response_cache()
+    return response_cache
+
 
-from dotenv import load_dotenv
+def get_llm_client():
+    global llm_client
+    with _init_lock:
+        if llm_client is None:
+            llm_client = build_llm_client()
+    return llm_client
 
-load_dotenv()
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
+def build_messages(prompt):
+    """Chat messages for a prompt, which is a string or already a message list"""
+    if isinstance(prompt, list):
+        return prompt
+    return [
+        {"role": "system", "content": "You are a helpful assistant."},
+        {"role": "user", "content": str(prompt)},
+    ]
 
 
-def chat(prompt):
-    completion = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant."},
-            {"role": "user", "content": str(prompt)},
-        ],
+def user_message(content):
+    return {"role": "user", "content": content}
+
+
+def assistant_message(content):
+    return {"role": "assistant", "content": content}
+
+
+def render_messages(messages):
+    """Messages as readable text, for logging"""
+    return "".join(
+        f"\n[{message['role']}]\n{message['content']}" for message in messages
     )
-    response = completion["choices"][0]["message"]["content"]
-    return response
+
+
+def response_key(model, messages, **params):
+    """The cache key of a chat completion in the current attempt"""
+    attempt = current_attempt.get()
+    if attempt > 1:
+        return cache_key(model, messages, attempt=attempt, **params)
+    return cache_key(model, messages, **params)
+
+
+def chat(prompt, model="gpt-3.5-turbo", priority=BACKGROUND, accept=None, **params):
+    """The response to prompt. accept(response) is false for unusable
+    responses, which are not cached."""
+    messages = build_messages(prompt)
+
+    def create():
+        completion = get_llm_client().create(
+            model=model, messages=messages, priority=priority, **params
+        )
+        usage = completion.get("usage") or {}
+        record_usage(
+            record,
+            model,
+            usage.get("prompt_tokens", 0),
+            usage.get("completion_tokens", 0),
+        )
+        return completion["choices"][0]["message"]["content"]
+
+    key = response_key(model, messages, **params)
+    # cache hits are recorded with zero tokens
+    with span("llm.chat") as record:
+        return get_response_cache().get_or_create(key, create, accept)
+
+
+def stream_chat(
+    prompt, model="gpt-3.5-turbo", priority=BACKGROUND, accept=None, **params
+):
+    """Like chat, but yields the response in pieces as they are generated.
+
+    A cached response is yielded in one piece. A response is only cached when
+    the caller consumed the whole stream, and accept(response) if given.
+    """
+    messages = build_messages(prompt)
+    key = response_key(model, messages, **params)
+    cache = get_response_cache()
+    if cache.mode != "off":
+        cached = cache.get(key)
+        if cached is not None and (
+            accept is None or cache.mode == "replay" or accept(cached)
+        ):
+            yield cached
+            return
+        if cache.mode == "replay":
+            raise CacheMiss(f"No cached response for {key} in replay mode")
+
+    pieces = []
+    with span("llm.chat") as record:
+        try:
+            completion = get_llm_client().stream(
+                model=model, messages=messages, priority=priority, **params
+            )
+            try:
+                for piece in completion:
+                    pieces.append(piece)
+                    yield piece
+            finally:
+                completion.close()
+        finally:
+            # streamed responses carry no usage, count the tokens locally
+            record_usage(
+                record,
+                model,
+                sum(count_tokens(message["content"]) for message in messages),
+                count_tokens("".join(pieces)),
+            )
+    response = "".join(pieces)
+    if cache.mode != "off" and (accept is None or accept(response)):
+        cache.set(key, response)
+
+
+def parse_decision_and_action(text, actions=None):
+    """Parse a {"decision": ..., "action": ...} response, None if invalid or
+    if the action is not one of actions (an ActionRegistry) when given"""
+    start, end = text.find("{"), text.rfind("}")
+    try:
+        response = json.loads(text[start : end + 1])
+    except ValueError:
+        return None
+    if not isinstance(response, dict):
+        return None
+    action = str(response.get("action", "")).strip()
+    if not action or (actions is not None and actions.parse(action) is None):
+        return None
+    return str(response.get("decision", "")), action
 
 
 class OODA(object):
-    def __init__(self, observation):
+    # Ask for the decision and the action in one call instead of two. Falls
+    # back to two calls when the combined response cannot be parsed.
+    single_call = False
+    # Scheduling priority of the model calls, see prompts.client
+    priority = BACKGROUND
+
+    def __init__(
+        self, observation, stream=False, on_token=None, single_call=None, actions=None
+    ):
+        """Run one OODA loop on the observation.
+
+        With stream=True the model output is streamed, on_token(phase, piece)
+        is called with each new piece of the "decision" and "action" phases,
+        and the action phase stops as soon as a complete action is parsed.
+        single_call overrides the class default. actions is the ActionRegistry
+        the response is parsed with, responses without one of its actions are
+        not cached.
+        """
         self.observation = observation
+        self.actions = actions
         self.decision = None
         self.action = None
 
-        self.decision_prompt = self.build_decision_prompt(observation)
-        self.decision = chat(self.decision_prompt)
-
-        self.action_prompt = self.build_action_prompt(self.decision)
-        self.action = chat(self.action_prompt)
+        if single_call is None:
+            single_call = self.single_call
+        if single_call and self.decide_and_act(observation, stream, on_token):
+            return
+
+        with span("ooda.decision"):
+            self.decision_prompt = self.build_decision_prompt(observation)
+            if stream:
+                self.decision = self.stream_phase(
+                    "decision", self.decision_prompt, on_token
+                )
+            else:
+                self.decision = chat(self.decision_prompt, priority=self.priority)
+
+        with span("ooda.action"):
+            self.action_prompt = self.build_action_prompt(self.decision)
+            if stream:
+                self.action = self.stream_phase(
+                    "action", self.action_prompt, on_token, stop_at_action=True
+                )
+            else:
+                self.action = chat(
+                    self.action_prompt, priority=self.priority, accept=self.has_action
+                )
 
     def __repr__(self) -> str:
-        return self.decision_prompt + self.decision + self.action_prompt + self.action
+        return render_messages(self.action_prompt) + self.action
+
+    def retry_action(self, response):
+        """Ask again for the action only, after `response` held no valid
+        action, keeping the decision that was already made"""
+        with span("ooda.action_retry"):
+            self.action_prompt = self.build_retry_action_prompt(response)
+            self.action = chat(
+                self.action_prompt, priority=self.priority, accept=self.has_action
+            )
+
+    def decide_and_act(self, observation, stream=False, on_token=None):
+        """Get the decision and action from one structured response, returns
+        False if the response was unusable"""
+        with span("ooda.decision_action"):
+            prompt = self.build_decision_and_action_prompt(observation)
+            if stream:
+                response = self.stream_phase(
+                    "decision_action",
+                    prompt,
+                    on_token,
+                    accept=self.has_decision_and_action,
+                )
+            else:
+                response = chat(
+                    prompt, priority=self.priority, accept=self.has_decision_and_action
+                )
+        parsed = parse_decision_and_action(response, self.actions)
+        if parsed is None:
+            print(f"Unusable single call response, falling back: {response}")
+            return False
+        self.decision, self.action = parsed
+        self.decision_prompt = prompt
+        self.action_prompt = prompt + [assistant_message(self.decision)]
+        return True
+
+    def has_action(self, response):
+        return self.actions is None or self.actions.parse(response) is not None
+
+    def has_decision_and_action(self, response):
+        return parse_decision_and_action(response, self.actions) is not None
+
+    def stream_phase(
+        self, phase, prompt, on_token=None, stop_at_action=False, accept=None
+    ):
+        text = ""
+        pieces = stream_chat(prompt, priority=self.priority, accept=accept)
+        try:
+            for piece in pieces:
+                text += piece
+                if on_token is not None:
+                    on_token(phase, piece)
+                if stop_at_action and self.actions is not None and ")" in piece:
+                    action = self.actions.parser.complete(text)
+                    if action is not None:
+                        # stop generating, the rest of the output is unused
+                        return action
+        finally:
+            pieces.close()
+        return text
+
+    # The prompts are message lists that all start with the same messages:
+    # the role's static preamble, then the observation, which only grows by
+    # appending between two summaries of the discussion. Each step appends
+    # its instructions after them, so every call of every loop on a task
+    # shares the longest possible byte identical prefix with the previous
+    # one, which the provider can serve from its prompt cache.
+
+    def build_preamble(self):
+        """The static part of the prompts, identical for all tasks of a role"""
+        return f"""You are a helpful assistant.
+
+You work on a task in an OODA loop: observe, orient, decide and act.
 
-    def build_decision_prompt(self, observation):
-        return f"""
 ### OBSERVATION ###
 (This first section involves collecting information about the current
 task, both internally and externally. By observing and analyzing the available
 information, you gain awareness of the circumstances and identify potential
-next steps.)
-
-```
-{observation}
-```
+next steps. The observation is given in the next message.)
 
 ### ORIENTATION ###
-(Once you have reviewed the necessary information above, the next step is to orient
+(Once you have reviewed the necessary information, the next step is to orient
 yourself by interpreting and analyzing the data. This stage involves
 understanding the context, assessing the significance of the observations, and
 evaluating how they relate to your existing knowledge and mental models. By
@@ -57,7 +338,26 @@ situation, enabling you to make more informed decisions.)
 
 {self.orientation}
 
-### DECISION ###
+### ACTIONS ###
+
+All actions use the following syntax, similar to python functions:
+
+ACTION_NAME(ARGUMENT).
+
+I have the following actions available to me:
+{self.action_list}
+"""
+
+    def build_observation_prompt(self, observation):
+        return [
+            {"role": "system", "content": self.build_preamble()},
+            user_message(f"### OBSERVATION ###\n\n```\n{observation}\n```\n"),
+        ]
+
+    def build_decision_prompt(self, observation):
+        return self.build_observation_prompt(observation) + [
+            user_message(
+                """### DECISION ###
 (In this section, you use the insights gained from observation and orientation
 to make a decision to help achieve your goal. This involves considering
 various courses of action, evaluating their potential outcomes, and selecting
@@ -65,32 +365,52 @@ the most suitable option based on your analysis. It is crucial to consider
 both short-term and long-term implications and weigh the risks and benefits
 associated with each decision. Write your final decision at the end in a
 single sentence.)
-
 """
+            )
+        ]
 
     def build_action_prompt(self, decision):
-        return f"""
-
-{self.decision_prompt}
+        return self.decision_prompt + [
+            assistant_message(decision),
+            user_message(
+                """### ACT ###
 
-{self.decision}
-
-### ACT ###
+Given the decision above, I will perform the following action:
+"""
+            ),
+        ]
 
-All actions use the following syntax, similar to python functions:
+    def build_retry_action_prompt(self, response):
+        return self.build_action_prompt(self.decision) + [
+            assistant_message(response),
+            user_message(
+                """My previous answer was not one of the actions available to me.
 
-ACTION_NAME(ARGUMENT).
+Given the decision above, I will answer with exactly one action and nothing
+else:
+"""
+            ),
+        ]
 
-I have the following actions available to me:
-{self.action_list}
+    def build_decision_and_action_prompt(self, observation):
+        return self.build_decision_prompt(observation) + [
+            user_message(
+                """### ACT ###
 
-Given the decision above, I will perform the following action:
+Respond with only a JSON object with two keys: "decision", my final decision
+in a single sentence, and "action", the one action that carries it out. For
+example:
 
+{"decision": "...", "action": "ACTION_NAME(ARGUMENT)"}
 """
+            )
+        ]
 
 
 class AgentOODA(OODA):
-    def __init__(self, observation):
+    single_call = True
+
+    def __init__(self, observation, **kwargs):
         self.orientation = """
 My Situation: I am the Worker assigned to complete this Task which was created
 by my Client.
@@ -100,7 +420,9 @@ My Goal: Help the client complete this task so they mark it as complete.
 My Options:
 - I can ask an internet search engine to search the internet for information.
 - I can ask a web browser to access a URL.
+- I can read on where a long tool output was cut off.
 - I can ask a calculator to perform a calculation.
+- I can recall what earlier tasks of my client found, before searching again.
 - I can ask the client for more information.
 - I can provide a status update to the client in a message.
 - I can summarize information for myself and the client in a message.
@@ -108,13 +430,17 @@ My Options:
         self.action_list = """
 - SEARCH_WEB(QUERY)
 - ACCESS_URL(URL)
-- CALCULATE_EXPRESSION(EXPRESSION)
+- READ_MORE(REFERENCE PART), e.g. READ_MORE(3f2a9c1b07de 2) as noted where a
+  tool output was cut off
+- CALCULATE_EXPRESSION(EXPRESSION), e.g. CALCULATE_EXPRESSION(12 km / 40 minute to kph)
+  or CALCULATE_EXPRESSION(mean([3, 5, 10])), with numbers, lists and units
+- RECALL(KEYWORDS), e.g. RECALL(body shop san francisco reviews)
 - MESSAGE_CLIENT(MESSAGE)"""
-        super().__init__(observation)
+        super().__init__(observation, **kwargs)
 
 
 class ManagerOODA(OODA):
-    def __init__(self, observation):
+    def __init__(self, observation, **kwargs):
         self.orientation = """
 My Situation: I am the Worker assigned to manage this Task which was created
 by my Client. I can see the Task message history and any subtasks.
@@ -129,17 +455,25 @@ My Options:
 - I can ask the client for more information.
 - I can create a plan for how to complete the task.
 - I can create a subtask for a step in the plan.
+- I can create several subtasks at once for independent steps in the plan,
+  which other Workers complete in parallel. When all subtasks are complete
+  I will receive their results.
 - I can close any subtask that is obsolete.
         """
         self.action_list = """
 - MESSAGE_CLIENT(MESSAGE)
 - CREATE_PLAN(TEXT)
-- CREATE_SUBTASK(TITLE)"""
-        super().__init__(observation)
+- CREATE_SUBTASK(TITLE)
+- CREATE_SUBTASKS(TITLE | TITLE | ...)"""
+        super().__init__(observation, **kwargs)
 
 
 class ClientOODA(OODA):
-    def __init__(self, observation):
+    single_call = True
+    # the client side waits on these, run them ahead of background work
+    priority = INTERACTIVE
+
+    def __init__(self, observation, **kwargs):
         self.orientation = """
 My Situation: I am the Client that created this Task to a Worker.
 
@@ -154,10 +488,13 @@ My Options:
         self.action_list = """
 - MESSAGE_WORKER(MESSAGE)
 - MARK_TASK_COMPLETE()"""
-        super().__init__(observation)
+        super().__init__(observation, **kwargs)
 
 
 if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
     while True:
         prompt = input("Enter your prompt: ")  # ex: "Client: Book a dinner for 2"
         ooda = OODA(prompt)
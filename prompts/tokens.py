@@ -0,0 +1,9 @@
+import re
+
+# Words and punctuation, long words count one token per 4 characters. This is
+# close enough to the model tokenizer for budgeting and needs no download.
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+def count_tokens(text):
+    return sum((len(token) + 3) // 4 for token in TOKEN_PATTERN.findall(text))
@@ -0,0 +1,135 @@
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from prompts.cache import MemoryCache
+
+
+def normalize_query(query):
+    """Map queries differing only in case, whitespace or punctuation to the
+    same cache key. Word order is kept, it can change what a query means."""
+    return " ".join(re.findall(r"\w+", query.lower()))
+
+
+class SearchError(Exception):
+    """The search provider answered with an error instead of results"""
+
+
+class SerpApiBingProvider(object):
+    """Bing organic results through SerpAPI"""
+
+    def __init__(self, api_key, country="US"):
+        self.api_key = api_key
+        self.country = country
+
+    def search(self, query):
+        from serpapi import BingSearch
+
+        params = {"q": query, "cc": self.country, "api_key": self.api_key}
+        response = BingSearch(params).get_dict()
+        # e.g. an invalid key or no searches left, which must not be cached
+        # as a query without results
+        if "error" in response:
+            raise SearchError(f"SerpAPI: {response['error']}")
+        return response.get("organic_results", [])
+
+
+class FakeSearchProvider(object):
+    """Deterministic offline results for tests and benchmarks"""
+
+    def __init__(self, latency=0.0, results_per_query=5):
+        self.latency = latency
+        self.results_per_query = results_per_query
+        self.calls = 0
+
+    def search(self, query):
+        self.calls += 1
+        time.sleep(self.latency)
+        slug = "-".join(re.findall(r"\w+", query.lower()))
+        return [
+            {
+                "position": i,
+                "title": f"Result {i} for {query}",
+                "link": f"https://example.com/{slug}/{i}",
+                "snippet": f"Snippet {i} about {query}.",
+            }
+            for i in range(1, self.results_per_query + 1)
+        ]
+
+
+class RateLimiter(object):
+    """Token bucket allowing `rate` calls per second with bursts of `burst`"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated_at) * self.rate
+                )
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def format_results(query, results):
+    lines = [f"# Website results for the query: {query}\n\n"]
+    for r in results:
+        line = f"{r['position']}. [{r['title']}]({r['link']})"
+        if "snippet" in r:
+            line += f" - {r['snippet']}"
+        lines.append(line + "\n")
+    return "".join(lines)
+
+
+class Searcher(object):
+    """Runs web searches through a provider with a normalized-query cache,
+    a rate limit and a thread pool for batches of queries"""
+
+    def __init__(self, provider, cache=None, rate_limiter=None, max_workers=4):
+        self.provider = provider
+        self.cache = cache if cache is not None else MemoryCache(1024, ttl=86400)
+        self.rate_limiter = rate_limiter
+        self.max_workers = max_workers
+
+    def search(self, query):
+        key = normalize_query(query)
+        # a query of only punctuation has no key worth sharing
+        results = self.cache.get(key) if key else None
+        if results is None:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            results = self.provider.search(query)
+            if key:
+                self.cache.set(key, results)
+        return results
+
+    def search_many(self, queries):
+        """Search many queries concurrently, returns {query: results or
+        exception}. Queries that normalize to the same key are searched once."""
+        by_key = {}
+        for query in queries:
+            by_key.setdefault(normalize_query(query) or query, query)
+
+        def search(query):
+            try:
+                return self.search(query)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = dict(zip(by_key, executor.map(search, by_key.values())))
+        return {
+            query: results[normalize_query(query) or query] for query in queries
+        }
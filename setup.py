@@ -1,4 +1,5 @@
 from app import app, db, User
+from migrate import upgrade_database
 
 
 def create_user(username, email, password, is_admin=False):
@@ -12,12 +13,13 @@ def create_user(username, email, password, is_admin=False):
 
 if __name__ == "__main__":
     with app.app_context():
-        # Create the tables if they don't exist
-        db.create_all()
+        # Create the tables if they don't exist, upgrade them if they do
+        upgrade_database()
 
         create_user("admin", "admin@example.com", "adminpassword", True)
         create_user("alice", "alice@example.com", "alicepassword")
         create_user("ai", "ai@example.com", "aipassword")
         create_user("managerai", "managerai@example.com", "aipassword")
         create_user("clientai", "clientai@example.com", "aipassword")
-        create_user("agentai", "agentai@example.com", "aipassword")
+        for username in app.config["AI_AGENT_USERNAMES"]:
+            create_user(username, f"{username}@example.com", "aipassword")
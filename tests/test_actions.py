@@ -0,0 +1,60 @@
+import pytest
+
+from prompts.actions import Action, ActionParser, ActionRegistry
+from prompts.prompts import parse_decision_and_action
+
+NAMES = ["MESSAGE_CLIENT", "SEARCH_WEB", "RECALL", "CREATE_SUBTASK", "CREATE_SUBTASKS"]
+
+
+@pytest.fixture
+def parser():
+    return ActionParser(NAMES)
+
+
+@pytest.mark.parametrize(
+    "text, action",
+    [
+        ("SEARCH_WEB(body shops)", Action("SEARCH_WEB", "body shops")),
+        ("I will search.\nSEARCH_WEB(body shops)", Action("SEARCH_WEB", "body shops")),
+        ('MESSAGE_CLIENT("Hi (again)")', Action("MESSAGE_CLIENT", "Hi (again)")),
+        ("CREATE_SUBTASKS(a | b)", Action("CREATE_SUBTASKS", "a | b")),
+        # repairs
+        ("search_web(body shops)", Action("SEARCH_WEB", "body shops")),
+        ("SEARCH_WEB(body shops\nmore", Action("SEARCH_WEB", "body shops")),
+        ("Decision made.\nRECALL: body shops", Action("RECALL", "body shops")),
+    ],
+)
+def test_parse(parser, text, action):
+    assert parser.parse(text) == action
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "I will recall what I know and then answer.",
+        "Using search_web was useful; now I will message_client about it.",
+        "Recall: body shops",
+        "Then RECALL: body shops",
+        "ANSWER(42)",
+        "",
+    ],
+)
+def test_prose_is_not_an_action(parser, text):
+    assert parser.parse(text) is None
+
+
+def test_complete_waits_for_the_closing_parenthesis(parser):
+    assert parser.complete("ANSWER(42) then SEARCH_WEB(a (b)") is None
+    assert parser.complete("ANSWER(42) then SEARCH_WEB(a (b))") == "SEARCH_WEB(a (b))"
+
+
+def test_decision_and_action_must_use_a_registered_action():
+    actions = ActionRegistry()
+    actions.register("RECALL")(lambda ai, task, as_user, argument: None)
+    response = '{"decision": "Look it up", "action": "%s"}'
+    assert parse_decision_and_action(response % "RECALL(shops)", actions) == (
+        "Look it up",
+        "RECALL(shops)",
+    )
+    assert parse_decision_and_action(response % "ANSWER(42)", actions) is None
+    assert parse_decision_and_action("not json", actions) is None
@@ -0,0 +1,67 @@
+import time
+
+import pytest
+
+from calculator import CalculationError, calculate
+
+
+@pytest.mark.parametrize(
+    "expression, expected",
+    [
+        ("2 * (3 + 4)", "14"),
+        ("prod([2, 3, 4])", "24"),
+        ("sum(range(1, 10000))", "49995000"),
+        ("(2 km)**3", "8000000000 m^3"),
+        ("m**9999", "1 m^9999"),
+        ("sqrt([1, 4, 9]) * 2", "[2, 4, 6]"),
+    ],
+)
+def test_results(expression, expected):
+    assert calculate(expression) == expected
+
+
+@pytest.mark.parametrize(
+    "expression",
+    [
+        "2**100000",
+        "9**9**9",
+        "(km**9999)**9999",
+        "(10 km)**5000",
+        "prod(range(1, 10000))",
+        "prod(range(1, 5000)) * 2",
+        "range(100000)",
+        # each list is allowed, but not building this many items in total
+        " + ".join(["range(10000)"] * 12),
+        # nested too deep to evaluate recursively
+        "+".join(["1"] * 999),
+        "-" * 1500 + "1",
+        "__import__('os')",
+        "(lambda: 1)()",
+        "[1, 2].__class__",
+    ],
+)
+def test_expensive_or_unsafe_expressions_are_refused(expression):
+    start = time.monotonic()
+    with pytest.raises(CalculationError):
+        calculate(expression)
+    # refused up front, not after doing the work
+    assert time.monotonic() - start < 1.0
+
+
+def test_time_limit():
+    with pytest.raises(CalculationError, match="Time limit"):
+        calculate("sum(sqrt(range(10000)) * sqrt(range(10000)))", time_limit=0.0)
+
+
+def test_only_calculation_errors_escape():
+    # tools.calculate_expression turns these into a message for the AI
+    for expression in ["1 / 0", "log(-1)", "5 km + 3 s", "1e308 * 1e308 ** 2"]:
+        with pytest.raises(CalculationError):
+            calculate(expression)
+
+
+def test_tool_returns_errors_as_text():
+    import tools
+
+    assert tools.calculate_expression("prod(range(1, 10000))").startswith("Error:")
+    assert tools.calculate_expression("(km**9999)**9999").startswith("Error:")
@@ -0,0 +1,227 @@
+import asyncio
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from prompts.client import (
+    BACKGROUND,
+    INTERACTIVE,
+    LLMClient,
+    OpenAITransport,
+    TokenBucket,
+)
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+class Handler(BaseHTTPRequestHandler):
+    """A chat completions endpoint that answers each request with the next
+    scripted reply, e.g. {"status": 429, "headers": {"Retry-After": "0.2"}},
+    {"delay": 1}, or {"pieces": ["a", "b"], "stall": 2} for a stream that
+    stalls after its pieces. Unscripted requests get "ok"."""
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append(
+            (time.monotonic(), body["messages"][-1]["content"])
+        )
+        reply = self.server.script.pop(0) if self.server.script else {}
+        time.sleep(reply.get("delay", 0))
+        status = reply.get("status", 200)
+        if status != 200:
+            return self.send(status, {"error": {"message": "scripted"}}, reply)
+        if not body.get("stream"):
+            return self.send(200, completion(reply.get("content", "ok")), reply)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for piece in reply.get("pieces", ["o", "k"]):
+            self.event(chunk(piece))
+        time.sleep(reply.get("stall", 0))
+        self.event("[DONE]")
+
+    def send(self, status, payload, reply):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        for name, value in reply.get("headers", {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def event(self, data):
+        if not isinstance(data, str):
+            data = json.dumps(data)
+        try:
+            self.wfile.write(f"data: {data}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        except ConnectionError:
+            # the client gave up on a stalled stream
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+def completion(content):
+    return {
+        "id": "chatcmpl-test",
+        "object": "chat.completion",
+        "created": 0,
+        "model": "test",
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+    }
+
+
+def chunk(piece):
+    return {
+        "id": "chatcmpl-test",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": "test",
+        "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}],
+    }
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    server.script = []
+    # (time, last message) of every request, in order
+    server.requests = []
+    threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    ).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def make_client(server):
+    def make_client(**options):
+        base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+        options.setdefault("backoff_base", 0.01)
+        return LLMClient(
+            transport=OpenAITransport(api_key="test", base_url=base_url), **options
+        )
+
+    return make_client
+
+
+def test_create_and_stream(server, make_client):
+    client = make_client()
+    server.script = [{"content": "Hello"}, {"pieces": ["Hel", "lo"]}]
+    response = client.create("test", MESSAGES)
+    assert response["choices"][0]["message"]["content"] == "Hello"
+    assert list(client.stream("test", MESSAGES)) == ["Hel", "lo"]
+
+
+def test_retry_after_is_honored(server, make_client):
+    client = make_client()
+    server.script = [{"status": 429, "headers": {"Retry-After": "0.3"}}]
+    response = client.create("test", MESSAGES)
+    assert response["choices"][0]["message"]["content"] == "ok"
+    (first, _), (second, _) = server.requests
+    assert second - first >= 0.3
+
+
+def test_server_errors_are_retried_with_backoff(server, make_client):
+    client = make_client(max_retries=2)
+    server.script = [{"status": 503}, {"status": 500}, {"status": 502}]
+    with pytest.raises(Exception) as error:
+        client.create("test", MESSAGES)
+    assert error.value.status_code == 502
+    assert len(server.requests) == 3
+
+
+def test_client_errors_are_not_retried(server, make_client):
+    client = make_client()
+    server.script = [{"status": 400}]
+    with pytest.raises(Exception) as error:
+        client.create("test", MESSAGES)
+    assert error.value.status_code == 400
+    assert len(server.requests) == 1
+
+
+def test_interactive_requests_run_first(server, make_client):
+    client = make_client(max_concurrency=1)
+    server.script = [{"delay": 0.3}]
+    threads = [
+        threading.Thread(
+            target=client.create,
+            args=("test", [{"role": "user", "content": name}]),
+            kwargs={"priority": priority},
+        )
+        for name, priority in [
+            ("first", BACKGROUND),
+            ("background", BACKGROUND),
+            ("interactive", INTERACTIVE),
+        ]
+    ]
+    for thread in threads:
+        thread.start()
+        # queued in this order while the first request is in flight
+        time.sleep(0.05)
+    for thread in threads:
+        thread.join()
+    assert [content for _, content in server.requests] == [
+        "first",
+        "interactive",
+        "background",
+    ]
+
+
+def test_wait_timeout(server, make_client):
+    client = make_client(timeout=5, wait_timeout=0.3)
+    server.script = [{"delay": 1}]
+    start = time.perf_counter()
+    with pytest.raises(TimeoutError):
+        client.create("test", MESSAGES)
+    assert time.perf_counter() - start < 0.8
+
+
+def test_stalled_stream_times_out(server, make_client):
+    client = make_client(timeout=0.3, max_retries=0)
+    server.script = [{"pieces": ["a", "b"], "stall": 2}]
+    pieces = []
+    start = time.perf_counter()
+    with pytest.raises(TimeoutError):
+        for piece in client.stream("test", MESSAGES):
+            pieces.append(piece)
+    assert pieces == ["a", "b"]
+    assert time.perf_counter() - start < 1.5
+
+
+def test_request_rate_limit(server, make_client):
+    client = make_client(requests_per_minute=60)
+    client.create("test", MESSAGES)
+    # drained, it refills at one request per second
+    client.request_bucket.tokens = 0
+    client.request_bucket.updated_at = time.monotonic()
+    start = time.perf_counter()
+    client.create("test", MESSAGES)
+    assert time.perf_counter() - start >= 0.9
+
+
+def test_token_bucket():
+    bucket = TokenBucket(per_minute=600)
+    start = time.perf_counter()
+    asyncio.run(bucket.acquire(600))
+    assert time.perf_counter() - start < 0.1
+    # usage charged after the fact is paid back before the next request
+    bucket.debit(2)
+    asyncio.run(bucket.acquire(1))
+    assert time.perf_counter() - start >= 0.25
@@ -0,0 +1,143 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from fetcher import DiskCache, Fetcher
+
+ETAG = '"v1"'
+LAST_MODIFIED = "Wed, 21 Oct 2015 07:28:00 GMT"
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/etag":
+            if self.headers.get("If-None-Match") == ETAG:
+                return self.reply(304)
+            self.reply(200, "<h1>Tagged</h1>", {"ETag": ETAG})
+        elif self.path == "/dated":
+            if self.headers.get("If-Modified-Since") == LAST_MODIFIED:
+                return self.reply(304)
+            self.reply(200, "<h1>Dated</h1>", {"Last-Modified": LAST_MODIFIED})
+        elif self.path == "/private":
+            self.reply(200, "<p>private</p>", {"Cache-Control": "private, no-store"})
+        elif self.path == "/big":
+            self.reply(200, "<p>" + "x" * 200_000 + "</p>")
+        elif self.path == "/slow":
+            time.sleep(2)
+            self.reply(200, "<p>late</p>")
+        else:
+            self.reply(404, "<p>not found</p>")
+
+    def reply(self, status, body="", headers=None):
+        self.server.responses.append((self.path, status))
+        data = body.encode("utf-8")
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if status != 304:
+            try:
+                self.wfile.write(data)
+            except ConnectionError:
+                # the client stopped reading, see the max_bytes test
+                pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    # (path, status) of every response, in order
+    server.responses = []
+    threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    ).start()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize("path, title", [("/etag", "Tagged"), ("/dated", "Dated")])
+def test_conditional_get_reuses_cached_markdown(server, tmp_path, path, title):
+    fetcher = Fetcher(cache=DiskCache(str(tmp_path)), fresh_for=0)
+    first = fetcher.get_markdown(server.url + path)
+    second = fetcher.get_markdown(server.url + path)
+    assert title in first
+    assert second == first
+    assert server.responses == [(path, 200), (path, 304)]
+    # the validators survive a 304 that omits them
+    entry = DiskCache(str(tmp_path)).get(server.url + path)
+    assert entry["etag"] or entry["last_modified"]
+    assert fetcher.get_markdown(server.url + path) == first
+    assert server.responses[-1] == (path, 304)
+
+
+def test_fresh_pages_are_served_without_a_request(server, tmp_path):
+    fetcher = Fetcher(cache=DiskCache(str(tmp_path)), fresh_for=3600)
+    assert fetcher.get_markdown(server.url + "/etag") == fetcher.get_markdown(
+        server.url + "/etag"
+    )
+    assert server.responses == [("/etag", 200)]
+
+
+def test_no_store_responses_are_not_cached(server, tmp_path):
+    fetcher = Fetcher(cache=DiskCache(str(tmp_path)), fresh_for=3600)
+    fetcher.get_markdown(server.url + "/private")
+    fetcher.get_markdown(server.url + "/private")
+    assert server.responses == [("/private", 200), ("/private", 200)]
+    assert not list(tmp_path.iterdir())
+
+
+def test_disk_cache_drops_old_entries_then_the_oldest_above_max_bytes(tmp_path):
+    cache = DiskCache(str(tmp_path), max_bytes=250, max_age=3600, prune_every=1)
+    entry = {"markdown": "x" * 50}
+    cache.set("https://example.com/expired", entry)
+    expired = time.time() - 7200
+    os.utime(cache._path("https://example.com/expired"), (expired, expired))
+    assert cache.get("https://example.com/expired") is None
+    for i in range(3):
+        cache.set(f"https://example.com/{i}", entry)
+        # distinct modification times
+        past = time.time() - 10 + i
+        os.utime(cache._path(f"https://example.com/{i}"), (past, past))
+    cache.set("https://example.com/3", entry)
+    assert [cache.get(f"https://example.com/{i}") for i in range(4)] == [
+        None,
+        entry,
+        entry,
+        entry,
+    ]
+    assert len(list(tmp_path.iterdir())) == 3
+
+
+def test_body_is_cut_off_after_max_bytes(server):
+    markdown = Fetcher(max_bytes=1000).get_markdown(server.url + "/big")
+    assert 0 < markdown.count("x") <= 1000 - len("<p>")
+
+
+def test_timeout(server):
+    fetcher = Fetcher(timeout=0.2)
+    start = time.perf_counter()
+    with pytest.raises(requests.exceptions.Timeout):
+        fetcher.get_markdown(server.url + "/slow")
+    assert time.perf_counter() - start < 1.5
+
+
+def test_batch_maps_each_url_to_markdown_or_error(server):
+    ok, missing = server.url + "/etag", server.url + "/missing"
+    results = Fetcher().get_many_markdown([ok, missing, ok])
+    assert list(results) == [ok, missing]
+    assert "Tagged" in results[ok]
+    assert isinstance(results[missing], requests.exceptions.HTTPError)
+    assert results[missing].response.status_code == 404
@@ -0,0 +1,87 @@
+import threading
+
+import pytest
+
+from prompts import prompts
+from prompts.actions import ActionParser
+from prompts.cache import MemoryCache, ResponseCache, SQLiteCache
+
+
+def has_action(response):
+    return ActionParser(["MESSAGE_CLIENT"]).parse(response) is not None
+
+
+class FakeClient(object):
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = 0
+
+    def create(self, model, messages, priority, **params):
+        self.calls += 1
+        content = self.responses.pop(0)
+        return {"choices": [{"message": {"content": content}}]}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(prompts, "response_cache", ResponseCache([MemoryCache()]))
+    client = FakeClient(["no action here", "MESSAGE_CLIENT(hi)", "SEARCH_WEB(x)"])
+    monkeypatch.setattr(prompts, "llm_client", client)
+    return client
+
+
+def test_unusable_responses_are_not_cached(client):
+    assert prompts.chat("act", accept=has_action) == "no action here"
+    assert prompts.chat("act", accept=has_action) == "MESSAGE_CLIENT(hi)"
+    assert prompts.chat("act", accept=has_action) == "MESSAGE_CLIENT(hi)"
+    assert client.calls == 2
+
+
+def test_retried_attempts_get_new_responses(client):
+    client.responses.pop(0)
+    assert prompts.chat("act") == "MESSAGE_CLIENT(hi)"
+    token = prompts.current_attempt.set(2)
+    try:
+        assert prompts.chat("act") == "SEARCH_WEB(x)"
+        assert prompts.chat("act") == "SEARCH_WEB(x)"
+    finally:
+        prompts.current_attempt.reset(token)
+    assert prompts.chat("act") == "MESSAGE_CLIENT(hi)"
+    assert client.calls == 2
+
+
+def test_replay_serves_unusable_responses():
+    cache = ResponseCache([MemoryCache()], mode="replay")
+    cache.set("key", "no action here")
+    assert cache.get_or_create("key", None, has_action) == "no action here"
+
+
+def test_sqlite_hits_only_touch_stale_entries(tmp_path):
+    cache = SQLiteCache(str(tmp_path / "cache.db"), touch_interval=60)
+    cache.set("key", "value")
+    conn = cache._connect()
+    changes = conn.total_changes
+    assert cache.get("key") == "value"
+    assert conn.total_changes == changes
+    with conn:
+        conn.execute("UPDATE response SET accessed_at = accessed_at - 120")
+    changes = conn.total_changes
+    assert cache.get("key") == "value"
+    assert conn.total_changes == changes + 1
+
+
+def test_counters_are_exact_across_threads():
+    cache = ResponseCache([MemoryCache()])
+    cache.set("hit", "value")
+
+    def lookup():
+        for _ in range(1000):
+            cache.get("hit")
+            cache.get("miss")
+
+    threads = [threading.Thread(target=lookup) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert (cache.hits, cache.misses) == (8000, 8000)
@@ -0,0 +1,51 @@
+import sys
+import types
+
+import pytest
+
+from prompts.cache import MemoryCache
+from search import SearchError, Searcher, SerpApiBingProvider
+
+
+@pytest.fixture
+def responses(monkeypatch):
+    """SerpAPI responses to return, in order, from a stubbed BingSearch"""
+    responses = []
+
+    class BingSearch(object):
+        def __init__(self, params):
+            self.params = params
+
+        def get_dict(self):
+            return responses.pop(0)
+
+    serpapi = types.SimpleNamespace(BingSearch=BingSearch)
+    monkeypatch.setitem(sys.modules, "serpapi", serpapi)
+    return responses
+
+
+def test_errors_are_raised_and_not_cached(responses):
+    searcher = Searcher(SerpApiBingProvider("key"), cache=MemoryCache())
+    responses.append({"error": "Your account has run out of searches."})
+    with pytest.raises(SearchError, match="run out of searches"):
+        searcher.search("body shops")
+    results = [{"position": 1, "title": "Shop", "link": "https://example.com"}]
+    responses.append({"organic_results": results})
+    assert searcher.search("body shops") == results
+    assert searcher.search("Body shops!") == results
+    assert not responses
+
+
+def test_no_results(responses):
+    searcher = Searcher(SerpApiBingProvider("key"), cache=MemoryCache())
+    responses.append({"search_metadata": {"status": "Success"}})
+    assert searcher.search("xyzzy plugh") == []
+    assert searcher.search("xyzzy plugh") == []
+
+
+def test_normalized_queries_keep_word_order(responses):
+    searcher = Searcher(SerpApiBingProvider("key"), cache=MemoryCache())
+    responses.extend([{"organic_results": [1]}, {"organic_results": [2]}])
+    assert searcher.search("flights from Paris to London") == [1]
+    assert searcher.search("  flights from paris, to london?") == [1]
+    assert searcher.search("flights from London to Paris") == [2]
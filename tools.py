@@ -1,42 +1,123 @@
 import os
+import threading
 
-import html2text
-import requests
-from dotenv import load_dotenv
-from serpapi import BingSearch
+from calculator import CalculationError, calculate
+from fetcher import DiskCache, Fetcher
+from instrumentation import timed
+from prompts.cache import MemoryCache
+from search import (
+    FakeSearchProvider,
+    RateLimiter,
+    Searcher,
+    SerpApiBingProvider,
+    format_results,
+)
 
-load_dotenv()
+basedir = os.path.abspath(os.path.dirname(__file__))
 
 
+def build_fetcher():
+    return Fetcher(
+        timeout=float(os.getenv("FETCH_TIMEOUT", 10)),
+        max_bytes=int(os.getenv("FETCH_MAX_BYTES", 2_000_000)),
+        cache=DiskCache(
+            os.getenv("FETCH_CACHE_DIR", os.path.join(basedir, "fetch_cache")),
+            max_bytes=int(os.getenv("FETCH_CACHE_MAX_BYTES", 500_000_000)),
+            max_age=float(os.getenv("FETCH_CACHE_MAX_AGE", 7 * 86400)),
+        ),
+        fresh_for=float(os.getenv("FETCH_CACHE_FRESH_SECONDS", 3600)),
+        max_workers=int(os.getenv("FETCH_MAX_WORKERS", 8)),
+    )
+
+
+search_providers = {
+    "serpapi": lambda: SerpApiBingProvider(api_key=os.getenv("SERPAPI_API_KEY")),
+    "fake": FakeSearchProvider,
+}
+
+
+def build_searcher():
+    return Searcher(
+        provider=search_providers[os.getenv("SEARCH_PROVIDER", "serpapi")](),
+        cache=MemoryCache(
+            max_entries=int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", 1024)),
+            ttl=float(os.getenv("SEARCH_CACHE_TTL", 86400)),
+        ),
+        rate_limiter=RateLimiter(
+            rate=float(os.getenv("SEARCH_RATE_PER_SECOND", 5)),
+            burst=int(os.getenv("SEARCH_RATE_BURST", 5)),
+        ),
+        max_workers=int(os.getenv("SEARCH_MAX_WORKERS", 4)),
+    )
+
+
+# Built on the first tool call rather than at import, so that the web app and
+# workers start without creating HTTP sessions and thread pools they may not
+# use. Assign them to replace the defaults, e.g. with fakes in benchmarks.
+fetcher = None
+searcher = None
+_init_lock = threading.Lock()
+
+
+def get_fetcher():
+    global fetcher
+    with _init_lock:
+        if fetcher is None:
+            fetcher = build_fetcher()
+    return fetcher
+
+
+def get_searcher():
+    global searcher
+    with _init_lock:
+        if searcher is None:
+            searcher = build_searcher()
+    return searcher
+
+
+calculator_time_limit = float(os.getenv("CALCULATOR_TIME_LIMIT", 0.1))
+
+
+@timed("tool.search")
 def get_organic_search_results(query):
-    params = {
-        "q": query,
-        "cc": "US",
-        "api_key": os.getenv("SERPAPI_API_KEY"),
+    return format_results(query, get_searcher().search(query))
+
+
+@timed("tool.search_many")
+def get_organic_search_results_many(queries):
+    """Search many queries concurrently, returns {query: markdown or exception}"""
+    results = get_searcher().search_many(queries)
+    return {
+        query: r if isinstance(r, Exception) else format_results(query, r)
+        for query, r in results.items()
     }
-    search = BingSearch(params)
-    results = search.get_dict()["organic_results"]
-    txt = f"# Website results for the query: {query}\n\n"
-    for r in results:
-        txt += f"{r['position']}. [{r['title']}]({r['link']})"
-        if "snippet" in r:
-            txt += f" - {r['snippet']}"
-        txt += "\n"
-    return txt
 
 
+@timed("tool.fetch")
 def get_markdown_from_url(url):
-    # Step 1 & 2: Download HTML from URL
-    response = requests.get(url)
-    html = response.text
-    # Step 3 & 4: Convert HTML to Markdown
-    text_maker = html2text.HTML2Text()
-    text_maker.ignore_links = False
-    markdown = text_maker.handle(html)
-    return markdown
+    return get_fetcher().get_markdown(url)
+
+
+@timed("tool.fetch_many")
+def get_markdown_from_urls(urls):
+    """Fetch many URLs concurrently, returns {url: markdown or exception}"""
+    return get_fetcher().get_many_markdown(urls)
+
+
+@timed("tool.calculate")
+def calculate_expression(expression):
+    """Evaluate an expression locally, errors are returned as text so that
+    the AI can correct the expression"""
+    try:
+        return calculate(expression, time_limit=calculator_time_limit)
+    except CalculationError as e:
+        return f"Error: {e}"
 
 
 if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
     result = get_organic_search_results("vegetarian resturants in san francisco")
     # usage
     url = "https://example.com"
@@ -0,0 +1,104 @@
+import threading
+import time
+
+
+class WorkerPool(object):
+    """A fixed pool of threads that drain a job queue.
+
+    The pool itself knows nothing about the database. `claim` is called with
+    no arguments and returns a job id (or None when the queue is empty), and
+    `run` is called with that job id. Each call gets an app context of its
+    own, and so its own database session and connection, which Flask-SQLAlchemy
+    removes and returns to the pool when the context ends.
+
+    When given, `heartbeat` is called every `heartbeat_interval` seconds with
+    the ids of the jobs being run (possibly none), so that the jobs of a pool
+    that died can be told apart from the ones still in progress.
+    """
+
+    def __init__(
+        self,
+        app,
+        claim,
+        run,
+        worker_count=2,
+        poll_interval=1.0,
+        heartbeat=None,
+        heartbeat_interval=20.0,
+    ):
+        self.app = app
+        self.claim = claim
+        self.run = run
+        self.worker_count = worker_count
+        self.poll_interval = poll_interval
+        self.heartbeat = heartbeat
+        self.heartbeat_interval = heartbeat_interval
+        self.threads = []
+        self.running = {}  # worker thread name -> job id
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+
+    def start(self):
+        for i in range(self.worker_count):
+            thread = threading.Thread(
+                target=self._work, name=f"ai-worker-{i}", daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+        if self.heartbeat is not None:
+            thread = threading.Thread(
+                target=self._beat, name="ai-worker-heartbeat", daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._wakeup.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def notify(self, task_id=None, user_ids=None):
+        """Wake idle workers, usable directly as a "tasks" pubsub listener"""
+        self._wakeup.set()
+
+    def _work(self):
+        while not self._stopping.is_set():
+            with self.app.app_context():
+                job_id = self.claim()
+            if job_id is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            name = threading.current_thread().name
+            self.running[name] = job_id
+            try:
+                with self.app.app_context():
+                    self.run(job_id)
+            finally:
+                self.running.pop(name, None)
+
+    def _beat(self):
+        while not self._stopping.wait(self.heartbeat_interval):
+            job_ids = list(self.running.values())
+            try:
+                with self.app.app_context():
+                    self.heartbeat(job_ids)
+            except Exception as e:
+                # a missed beat is made up by the next one
+                print(f"Heartbeat for jobs {job_ids} failed: {e}")
+
+
+if __name__ == "__main__":
+    # Run AI workers without the web server, e.g. `python worker.py`
+    from app import start_workers
+
+    pool = start_workers()
+    print(f"Started {pool.worker_count} AI workers")
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        pool.stop()